@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+# vim: set tw=99:
+
+# This file is part of FRC Replay, a system for automatically recording match
+# videos from live streams of FIRST games.
+
+# Copyright (C) 2017 Michael Smith <michael@spinda.net>
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+
+# You should have received a copy of the GNU Affero General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Stands in for FFmpeg in the soak test. Like the match observer's FFmpeg command, it reads the
+# stream from stdin and writes raw RGB frames to stdout at the size in its -vf scale filter, but
+# the frames are blank and come one per BLANK_FRAME_BYTES of input.
+
+import os
+import re
+import sys
+
+SCALE_RE = re.compile(r'scale=([0-9]+):([0-9]+)')
+STDIN_CHUNK_SIZE = 64 * 1024
+DEFAULT_FRAME_BYTES = 96 * 1024
+
+def main():
+    scale = SCALE_RE.search(sys.argv[sys.argv.index('-vf') + 1])
+    frame = bytes(int(scale.group(1)) * int(scale.group(2)) * 3)
+    frame_bytes = int(os.environ.get('BLANK_FRAME_BYTES', DEFAULT_FRAME_BYTES))
+
+    # Like FFmpeg, stdin is read until it's closed even if nothing reads the frames anymore.
+    frame_output = sys.stdout.buffer
+    received_bytes = 0
+    while True:
+        data = sys.stdin.buffer.read1(STDIN_CHUNK_SIZE)
+        if len(data) == 0:
+            break
+        received_bytes += len(data)
+
+        while received_bytes >= frame_bytes:
+            received_bytes -= frame_bytes
+            if frame_output is None:
+                continue
+            try:
+                frame_output.write(frame)
+                frame_output.flush()
+            except BrokenPipeError:
+                os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+                frame_output = None
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+# vim: set tw=99:
+
+# This file is part of FRC Replay, a system for automatically recording match
+# videos from live streams of FIRST games.
+
+# Copyright (C) 2017 Michael Smith <michael@spinda.net>
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+
+# You should have received a copy of the GNU Affero General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Measures how long `import matchrecorder` takes with `python -X importtime` and fails if it goes
+# over budget or pulls in modules that only the worker processes need.
+
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+
+IMPORT_TIME_MODULE = 'matchrecorder'
+IMPORT_TIME_RUNS = 5
+IMPORT_TIME_BUDGET = 0.3
+IMPORT_TIME_TOP_COUNT = 15
+
+DEFERRED_MODULES = ['cv2', 'numpy', 'scipy', 'pytesseract', 'PIL', 'twitter', 'requests_toolbelt']
+
+IMPORT_TIME_RE = re.compile(r'^import time:\s+([0-9]+) \|\s+([0-9]+) \|( *)(\S+)$')
+
+def measure_imports(module):
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                            cwd=ROOT_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    if result.returncode != 0:
+        raise Exception('Failed to import {}:\n{}'.format(module, result.stderr))
+
+    imports = []
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME_RE.match(line)
+        if match:
+            imports.append((match.group(4), int(match.group(2)) / 1e6, len(match.group(3))))
+    return imports
+
+def main():
+    module = sys.argv[1] if len(sys.argv) > 1 else IMPORT_TIME_MODULE
+
+    totals = []
+    for _ in range(IMPORT_TIME_RUNS):
+        imports = measure_imports(module)
+        totals.extend(cumulative for name, cumulative, _ in imports if name == module)
+    total = statistics.median(totals)
+
+    print('import {}: median {:.3f}s over {} runs (budget {:.3f}s)'.format(
+          module, total, IMPORT_TIME_RUNS, IMPORT_TIME_BUDGET))
+
+    top_level = sorted(((cumulative, name) for name, cumulative, depth in imports if depth <= 3),
+                       reverse=True)
+    for cumulative, name in top_level[:IMPORT_TIME_TOP_COUNT]:
+        print('  {:8.3f}s  {}'.format(cumulative, name))
+
+    ok = True
+    if total > IMPORT_TIME_BUDGET:
+        print('FAIL: over import time budget')
+        ok = False
+
+    imported = {name.split('.')[0] for name, _, _ in imports}
+    for deferred_module in DEFERRED_MODULES:
+        if deferred_module in imported:
+            print('FAIL: {} should only be imported by worker processes'.format(deferred_module))
+            ok = False
+
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+
+# vim: set tw=99:
+
+# This file is part of FRC Replay, a system for automatically recording match
+# videos from live streams of FIRST games.
+
+# Copyright (C) 2017 Michael Smith <michael@spinda.net>
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+
+# You should have received a copy of the GNU Affero General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Drives MatchRecorderStreamConnector through hours of stream time as fast as it will go, and fails
+# if its memory, file descriptors or child processes keep growing.
+#
+# The recorder runs against a simulated clock in a temporary videos directory. Stream data is
+# synthetic unless --input gives a recorded stream to loop; either way, --bitrate sets how much
+# stream time each byte stands for. Matches follow a fixed schedule, with every few of them long
+# enough to be split, and the stream drops and reconnects periodically. Finished clips go to an
+# upload stand-in that deletes them instead of posting them.
+#
+# The match observer is the real one, so every reconnect stops and starts its frame extractor and
+# background process, but blankframes.py stands in for FFmpeg and the vision core only runs its
+# overlay gate on the blank frames. With --detect, the real FFmpeg and vision core process the
+# (recorded) data, and the matches come from them instead of the schedule.
+
+import argparse
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.realpath(__file__))
+ROOT_DIR = os.path.join(BENCHMARKS_DIR, '..')
+sys.path.insert(0, ROOT_DIR)
+
+# The recorder's directories are set up at import time, so this has to come first.
+SOAK_VIDEOS_DIR = tempfile.mkdtemp(prefix='frcreplay-soak-')
+os.environ['FRCREPLAY_VIDEOS_DIR'] = SOAK_VIDEOS_DIR
+
+import matchobserver
+import matchrecorder
+import memorymonitor
+import videohandler
+
+SOAK_EVENT_ID = 'SOAK'
+SOAK_TWITTER_USER = 'frc_replay_soak'
+SOAK_GAME_ID = 'FRC-2017'
+
+SOAK_DURATION = 8 * 60 * 60
+SOAK_BITRATE = 32 * 1024
+SOAK_CHUNK_SIZE = io.DEFAULT_BUFFER_SIZE
+SOAK_ARCHIVE_MAX_BYTES = 64 * 1024 * 1024
+SOAK_SAMPLE_INTERVAL = 15 * 60
+SOAK_WARMUP_DURATION = 60 * 60
+
+DISCONNECT_INTERVAL = 50 * 60
+RECONNECT_DURATION = 5
+
+BLANK_FRAMES_PATH = os.path.join(BENCHMARKS_DIR, 'blankframes.py')
+BLANK_FRAME_RESOLUTION = (640, 360)
+
+MATCH_INTERVAL = 12 * 60
+MATCH_DURATION = 4 * 60
+LONG_MATCH_DURATION = 10 * 60
+LONG_MATCH_EVERY = 5
+
+UPLOAD_DURATION = 0.5
+DRAIN_TIMEOUT = 60
+
+RSS_GROWTH_LIMIT = 32 * 1024 * 1024
+FD_GROWTH_LIMIT = 4
+CHILD_LIMIT = 8
+
+class SimulatedClock:
+    def __init__(self):
+        self.start_time = time.time()
+        self._now = self.start_time
+
+    def time(self):
+        return self._now
+
+    def elapsed(self):
+        return self._now - self.start_time
+
+    def advance(self, duration):
+        self._now += duration
+
+    def sleep(self, duration):
+        time.sleep(duration)
+
+# Runs the match observer's processes as usual, but reports matches from a fixed schedule the way
+# MatchTracker would.
+class ScriptedMatchObserver(matchobserver.MatchObserver):
+    def __init__(self, clock, game_id):
+        super().__init__(SOAK_EVENT_ID, game_id, overlay_gate=True)
+        self._clock = clock
+        self._reported_match_id = None
+
+    def start(self, video_width, video_height):
+        super().start(video_width, video_height)
+        self._reported_match_id = None
+
+    def _scheduled_match_id(self):
+        elapsed = self._clock.elapsed()
+        match_index = int(elapsed // MATCH_INTERVAL)
+        match_duration = LONG_MATCH_DURATION if match_index % LONG_MATCH_EVERY == 0 \
+                         else MATCH_DURATION
+        if elapsed - match_index * MATCH_INTERVAL >= match_duration:
+            return None
+        return matchobserver.MATCH_ID_TEMPLATE.format(
+                SOAK_EVENT_ID, 'Qualification {}'.format(match_index + 1))
+
+    def has_update(self):
+        return self._scheduled_match_id() != self._reported_match_id
+
+    def get_latest(self):
+        self._reported_match_id = self._scheduled_match_id()
+        return self._reported_match_id
+
+def discard_upload(title, path, twitter_user):
+    time.sleep(UPLOAD_DURATION)
+    os.unlink(path)
+
+def iter_chunks(input_path):
+    synthetic_chunk = os.urandom(SOAK_CHUNK_SIZE)
+    while True:
+        if input_path is None:
+            yield synthetic_chunk
+            continue
+        with open(input_path, 'rb') as input_file:
+            while True:
+                chunk = input_file.read(SOAK_CHUNK_SIZE)
+                if len(chunk) == 0:
+                    break
+                yield chunk
+
+def log_sample(clock, memory_sample):
+    print('{:6.2f}h  {}'.format(clock.elapsed() / 60 / 60,
+                                memorymonitor.format_sample(memory_sample)))
+
+def run_soak(args):
+    clock = SimulatedClock()
+    matchrecorder.time = clock
+    matchrecorder.ARCHIVE_MAX_BYTES = args.archive_max_bytes
+    videohandler.upload_to_streamable_and_queue_tweet = discard_upload
+
+    connector = matchrecorder.MatchRecorderStreamConnector(SOAK_EVENT_ID, None, SOAK_TWITTER_USER,
+                                                           args.game_id)
+    if not args.detect:
+        matchobserver.FFMPEG_COMMAND = [sys.executable, BLANK_FRAMES_PATH] + \
+                                       matchobserver.FFMPEG_COMMAND[1:]
+        os.environ['BLANK_FRAME_BYTES'] = str(int(args.bitrate / matchobserver.MATCH_DETECTOR_FPS))
+        connector._match_observer = ScriptedMatchObserver(clock, args.game_id)
+        connector.detector_resolution = BLANK_FRAME_RESOLUTION
+
+    memory_monitor = memorymonitor.MemoryMonitor()
+    baseline_sample = None
+    peak_children = 0
+    next_sample_time = 0
+    next_disconnect_time = DISCONNECT_INTERVAL
+
+    connector.on_start()
+    connector.on_connecting()
+    connector.on_connected()
+
+    for chunk in iter_chunks(args.input):
+        if clock.elapsed() >= args.duration:
+            break
+
+        clock.advance(len(chunk) / args.bitrate)
+        connector.on_data(chunk)
+
+        if clock.elapsed() >= next_disconnect_time:
+            connector.on_disconnected()
+            clock.advance(RECONNECT_DURATION)
+            connector.on_connecting()
+            connector.on_connected()
+            next_disconnect_time += DISCONNECT_INTERVAL
+
+        if clock.elapsed() >= next_sample_time:
+            memory_sample = memorymonitor.sample()
+            log_sample(clock, memory_sample)
+            peak_children = max(peak_children, memory_sample['children'])
+            if baseline_sample is None and clock.elapsed() >= SOAK_WARMUP_DURATION:
+                baseline_sample = memory_sample
+                if args.trace:
+                    memory_monitor.diff_snapshot()
+            next_sample_time += SOAK_SAMPLE_INTERVAL
+
+    connector.on_disconnected()
+
+    drain_deadline = time.time() + DRAIN_TIMEOUT
+    while connector.pending_uploads() > 0 and time.time() < drain_deadline:
+        time.sleep(0.1)
+
+    final_sample = memorymonitor.sample()
+    log_sample(clock, final_sample)
+    if args.trace:
+        memory_monitor.diff_snapshot()
+
+    if baseline_sample is None:
+        print('The soak was too short to get past the warmup')
+        return 1
+
+    failures = []
+    rss_growth = final_sample['rss'] - baseline_sample['rss']
+    if rss_growth > RSS_GROWTH_LIMIT:
+        failures.append('RSS grew by {:.1f} MiB after warmup'.format(rss_growth / 1024 / 1024))
+    fd_growth = final_sample['fds'] - baseline_sample['fds']
+    if fd_growth > FD_GROWTH_LIMIT:
+        failures.append('{} file descriptors leaked after warmup'.format(fd_growth))
+    if peak_children > CHILD_LIMIT:
+        failures.append('{} child processes at once'.format(peak_children))
+    if connector.pending_uploads() > 0:
+        failures.append('{} uploads still pending'.format(connector.pending_uploads()))
+    elif final_sample['children'] > 0:
+        failures.append('{} child processes left behind'.format(final_sample['children']))
+
+    for failure in failures:
+        print('FAILURE: ' + failure)
+    return 1 if len(failures) > 0 else 0
+
+def main():
+    parser = argparse.ArgumentParser(description='Soak test the match recorder.')
+    parser.add_argument('--duration', type=float, default=SOAK_DURATION,
+                        help='simulated stream time, in seconds')
+    parser.add_argument('--bitrate', type=float, default=SOAK_BITRATE,
+                        help='stream bytes per simulated second')
+    parser.add_argument('--input', help='recorded stream to loop instead of synthetic data')
+    parser.add_argument('--detect', action='store_true',
+                        help='detect matches with the real vision core instead of a schedule')
+    parser.add_argument('--game-id', default=SOAK_GAME_ID)
+    parser.add_argument('--archive-max-bytes', type=int, default=SOAK_ARCHIVE_MAX_BYTES)
+    parser.add_argument('--trace', action='store_true',
+                        help='log the allocation sites that grew the most after warmup')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the temporary videos directory')
+    args = parser.parse_args()
+
+    if args.detect and args.input is None:
+        parser.error('--detect needs a recorded stream from --input')
+
+    try:
+        return run_soak(args)
+    finally:
+        if args.keep:
+            print('Kept videos in {}'.format(SOAK_VIDEOS_DIR))
+        else:
+            shutil.rmtree(SOAK_VIDEOS_DIR, ignore_errors=True)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+
+# vim: set tw=99:
+
+# This file is part of FRC Replay, a system for automatically recording match
+# videos from live streams of FIRST games.
+
+# Copyright (C) 2017 Michael Smith <michael@spinda.net>
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+
+# You should have received a copy of the GNU Affero General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Runs every game plugin's VisionCore over a labeled corpus of overlay frames at several
+# resolutions and reports per-field accuracy and process_frame latency, failing on regressions
+# against a stored baseline.
+#
+# The corpus lives in samples/<plugin name>/, e.g. samples/frc2017/, as frame images next to a
+# labels.json mapping each image filename to its expected fields:
+#
+#     {"qm12-teleop.png": {"match_id": "#Qualification Match 12", "red_score": 41,
+#                          "blue_score": 17, "match_period": "teleop", "match_time": 96},
+#      "awards.png": {"match_id": null}}
+#
+# Only the fields present in a frame's labels are checked.
+#
+# With --overlay-gate, the vision cores skip frames their overlay detector rejects, and the run
+# also fails if the detector rejects any frame labeled with a match id. Because accuracy is still
+# compared against the ungated baseline, this is how an OverlaySignature gets validated.
+
+import argparse
+import collections
+import importlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.realpath(__file__))
+ROOT_DIR = os.path.join(BENCHMARKS_DIR, '..')
+sys.path.insert(0, ROOT_DIR)
+
+import matchobserver
+
+SAMPLES_DIR = os.path.join(ROOT_DIR, 'samples')
+LABELS_FILENAME = 'labels.json'
+BASELINE_PATH = os.path.join(BENCHMARKS_DIR, 'visioncore-baseline.json')
+
+BENCHMARK_RESOLUTIONS = [(1920, 1080), (1280, 720), (854, 480)]
+LATENCY_PERCENTILES = [50, 95, 99]
+
+ACCURACY_TOLERANCE = 0.01
+LATENCY_TOLERANCE = 1.25
+
+_vision_cores = {}
+
+def percentile(sorted_values, p):
+    index = min(len(sorted_values) - 1, max(0, int(round(p / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+def init_worker():
+    # The vision cores narrate their OCR results; keep that out of the report.
+    sys.stdout = open(os.devnull, 'w')
+
+def find_corpora():
+    corpora = {}
+    for plugin_name in sorted(matchobserver.find_game_plugins()):
+        labels_path = os.path.join(SAMPLES_DIR, plugin_name, LABELS_FILENAME)
+        if os.path.isfile(labels_path):
+            with open(labels_path, 'r', encoding='utf-8') as labels_file:
+                corpora[plugin_name] = json.load(labels_file)
+    return corpora
+
+def run_frame(job):
+    import PIL.Image
+
+    plugin_name, resolution, overlay_gate, frame_filename, labels = job
+
+    vision_core = _vision_cores.get((plugin_name, resolution))
+    if vision_core is None:
+        plugin = importlib.import_module('matchobserver.' + plugin_name)
+        vision_core = plugin.VISION_CORE_CLASS(*resolution, advanced_scraping=True,
+                                               overlay_gate=overlay_gate)
+        _vision_cores[(plugin_name, resolution)] = vision_core
+    overlay_detector = vision_core._overlay_detector
+    frames_skipped = overlay_detector.frames_skipped if overlay_detector is not None else 0
+
+    frame = PIL.Image.open(os.path.join(SAMPLES_DIR, plugin_name, frame_filename)).convert('RGB')
+    if frame.size != resolution:
+        frame = frame.resize(resolution, PIL.Image.BILINEAR)
+
+    start_time = time.perf_counter()
+    match_id, match_info = vision_core.process_frame(frame)
+    latency = time.perf_counter() - start_time
+
+    results = dict(match_info, match_id=match_id)
+    correct = {field: results.get(field) == expected for field, expected in labels.items()}
+    if overlay_detector is not None:
+        skipped = overlay_detector.frames_skipped > frames_skipped
+        correct['overlay_gate'] = not (skipped and labels.get('match_id') is not None)
+    return (plugin_name, resolution, frame_filename, correct, latency)
+
+def summarize(results):
+    fields = collections.defaultdict(lambda: collections.defaultdict(list))
+    latencies = collections.defaultdict(list)
+    for plugin_name, resolution, _, correct, latency in results:
+        key = '{} {}x{}'.format(plugin_name, *resolution)
+        for field, is_correct in correct.items():
+            fields[key][field].append(is_correct)
+        latencies[key].append(latency)
+
+    summary = {}
+    for key in sorted(latencies):
+        sorted_latencies = sorted(latencies[key])
+        summary[key] = {
+            'frames': len(sorted_latencies),
+            'accuracy': {field: sum(values) / len(values)
+                         for field, values in sorted(fields[key].items())},
+            'latency': {'p{}'.format(p): percentile(sorted_latencies, p)
+                        for p in LATENCY_PERCENTILES}
+        }
+    return summary
+
+def find_regressions(summary, baseline):
+    regressions = []
+    for key, baseline_entry in sorted(baseline.items()):
+        entry = summary.get(key)
+        if entry is None:
+            regressions.append('{}: missing from results'.format(key))
+            continue
+
+        for field, baseline_accuracy in sorted(baseline_entry['accuracy'].items()):
+            accuracy = entry['accuracy'].get(field, 0)
+            if accuracy < baseline_accuracy - ACCURACY_TOLERANCE:
+                regressions.append('{}: {} accuracy {:.3f} < baseline {:.3f}'.format(
+                                   key, field, accuracy, baseline_accuracy))
+
+        for p, baseline_latency in sorted(baseline_entry['latency'].items()):
+            latency = entry['latency'].get(p)
+            if latency is not None and latency > baseline_latency * LATENCY_TOLERANCE:
+                regressions.append('{}: {} latency {:.4f}s > baseline {:.4f}s'.format(
+                                   key, p, latency, baseline_latency))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark VisionCore accuracy and latency.')
+    parser.add_argument('--jobs', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--overlay-gate', action='store_true',
+                        help='skip frames without the overlay, as with OVERLAY_GATE=1')
+    args = parser.parse_args()
+
+    if args.overlay_gate and args.update_baseline:
+        parser.error('the baseline is recorded without the overlay gate')
+
+    corpora = find_corpora()
+    if len(corpora) == 0:
+        print('No labeled corpora found in {}'.format(SAMPLES_DIR))
+        return 1
+
+    jobs = [(plugin_name, resolution, args.overlay_gate, frame_filename, labels)
+            for plugin_name, corpus in sorted(corpora.items())
+            for resolution in BENCHMARK_RESOLUTIONS
+            for frame_filename, labels in sorted(corpus.items())]
+
+    with multiprocessing.Pool(args.jobs, initializer=init_worker) as pool:
+        results = pool.map(run_frame, jobs, chunksize=max(1, len(jobs) // (args.jobs * 4)))
+
+    summary = summarize(results)
+    for key, entry in summary.items():
+        print('{} ({} frames)'.format(key, entry['frames']))
+        for field, accuracy in entry['accuracy'].items():
+            print('  {:16} {:6.1%}'.format(field, accuracy))
+        print('  latency          {}'.format(
+              '  '.join('{} {:.4f}s'.format(p, latency)
+                        for p, latency in entry['latency'].items())))
+
+    if args.update_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as baseline_file:
+            json.dump(summary, baseline_file, indent=2, sort_keys=True)
+        print('Updated baseline {}'.format(args.baseline))
+        return 0
+
+    regressions = []
+    for key, entry in summary.items():
+        if entry['accuracy'].get('overlay_gate', 1) < 1:
+            regressions.append('{}: overlay gate skipped {:.1%} of frames with a match'.format(
+                               key, 1 - entry['accuracy']['overlay_gate']))
+
+    try:
+        with open(args.baseline, 'r', encoding='utf-8') as baseline_file:
+            regressions += find_regressions(summary, json.load(baseline_file))
+    except FileNotFoundError:
+        print('No baseline at {}; run with --update-baseline to record one'.format(args.baseline))
+
+    for regression in regressions:
+        print('REGRESSION: ' + regression)
+    return 1 if len(regressions) > 0 else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
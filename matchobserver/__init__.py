@@ -18,144 +18,281 @@
 # You should have received a copy of the GNU Affero General Public License along
 # with this program. If not, see <http://www.gnu.org/licenses/>.
 
+import ast
 import collections
+import hashlib
+import importlib
 import multiprocessing
-import io
 import os
-import re
+import pickle
+import pkgutil
 import subprocess
+import tempfile
 import time
 import traceback
 
-import PIL
-
 MATCH_DETECTOR_FPS = 1 / 3
 FFMPEG_BINARY = '/usr/bin/ffmpeg'
-FFMPEG_COMMAND = [
-    FFMPEG_BINARY, '-i', '-', '-vf',
-    'fps={}'.format(MATCH_DETECTOR_FPS),
+FFMPEG_FRAME_FILTER = 'fps={},scale={{}}:{{}}'.format(MATCH_DETECTOR_FPS)
+FFMPEG_FRAME_OUTPUT = [
     '-an', '-sn', '-c:v', 'rawvideo', '-pix_fmt', 'rgb24', '-f', 'rawvideo', '-'
 ]
+FFMPEG_COMMAND = [FFMPEG_BINARY, '-i', '-', '-vf', FFMPEG_FRAME_FILTER] + FFMPEG_FRAME_OUTPUT
+
+DEFAULT_VIDEO_WIDTH = 1920
+DEFAULT_VIDEO_HEIGHT = 1080
 
 MATCH_ID_TEMPLATE = '#{} {}'
 
 MATCH_END_TIMEOUT = 60
 
-VIDEO_CHANNELS = 3
-
-VIDEO_RESOLUTION_RE = re.compile('rgb24, ([0-9]+)x([0-9]+)[, ]')
-
-def background_process(event_id, vision_core_class, info_stream, frame_stream, match_id_queue):
-    match_id = None
-    match_id_counter = collections.Counter()
-
-    change_timestamp = -1
-    end_timestamp = -1
+STOP_TIMEOUT = 10
 
-    video_width = None
-    video_height = None
-
-    while False:
-        info_line = info_stream.readline().decode('utf-8')
-        if len(info_line) == 0:
-            break
-
-        print(info_line)
-
-        match = VIDEO_RESOLUTION_RE.search(info_line)
-        if match:
-            video_width = int(match.group(1))
-            video_height = int(match.group(2))
-            break
+VIDEO_CHANNELS = 3
 
-    video_width=1920
-    video_height=1080
+PLUGINS_DIR = os.path.dirname(os.path.realpath(__file__))
+ASSET_CACHE_DIR = os.environ.get('MATCHOBSERVER_CACHE_DIR', os.path.join(PLUGINS_DIR, 'cache'))
+ASSET_CACHE_VERSION = 1
+
+_loaded_assets = {}
+
+def game_plugin_name(game_id):
+    return game_id.lower().replace('-', '')
+
+def read_plugin_game_id(plugin_name, is_package):
+    # A game plugin assigns GAME_ID a string and VISION_CORE_CLASS at its top level. Both are read
+    # from the source, so that the recorder process can tell plugins from helper modules like
+    # preprocess without importing them and everything they depend on.
+    if is_package:
+        source_path = os.path.join(PLUGINS_DIR, plugin_name, '__init__.py')
+    else:
+        source_path = os.path.join(PLUGINS_DIR, plugin_name + '.py')
+    try:
+        with open(source_path, 'r', encoding='utf-8') as source_file:
+            source = ast.parse(source_file.read(), source_path)
+    except FileNotFoundError:
+        return None
+
+    assigned = {}
+    for statement in source.body:
+        if isinstance(statement, ast.Assign):
+            for target in statement.targets:
+                if isinstance(target, ast.Name):
+                    assigned[target.id] = statement.value
+    if 'GAME_ID' not in assigned or 'VISION_CORE_CLASS' not in assigned:
+        return None
+    try:
+        game_id = ast.literal_eval(assigned['GAME_ID'])
+    except ValueError:
+        return None
+    return game_id if isinstance(game_id, str) else None
+
+def find_game_plugins():
+    # Maps the name of each game plugin to its game id.
+    plugins = {}
+    for _, name, is_package in pkgutil.iter_modules([PLUGINS_DIR]):
+        game_id = read_plugin_game_id(name, is_package)
+        if game_id is not None:
+            plugins[name] = game_id
+    return plugins
+
+def check_game_plugin(game_id):
+    plugin_name = game_plugin_name(game_id)
+    plugin_game_id = find_game_plugins().get(plugin_name)
+    if plugin_game_id is None:
+        raise Exception('Unrecognized game id: ' + game_id)
+    if plugin_game_id != game_id:
+        raise Exception('Plugin {} is for game id {}, not {}'.format(plugin_name, plugin_game_id,
+                                                                       game_id))
+    return plugin_name
+
+def load_game_plugin(game_id):
+    # Plugins are named after their game id ('FRC-2017' lives in frc2017), so the directory scan
+    # only has to read their sources and the selected plugin is the only one ever imported.
+    plugin_name = check_game_plugin(game_id)
+    return importlib.import_module('{}.{}'.format(__name__, plugin_name))
+
+def load_cached_asset(name, source_paths, compute):
+    key_hash = hashlib.sha1(str(ASSET_CACHE_VERSION).encode('utf-8'))
+    for source_path in source_paths:
+        source_stat = os.stat(source_path)
+        key_hash.update('{}:{}:{}'.format(os.path.realpath(source_path), source_stat.st_size,
+                                          source_stat.st_mtime_ns).encode('utf-8'))
+    key = '{}-{}'.format(name, key_hash.hexdigest())
+
+    if key in _loaded_assets:
+        return _loaded_assets[key]
+
+    cache_path = os.path.join(ASSET_CACHE_DIR, key + '.pickle')
+    try:
+        with open(cache_path, 'rb') as cache_file:
+            asset = pickle.load(cache_file)
+        print('******** loaded cached asset {}'.format(name))
+    except FileNotFoundError:
+        asset = compute()
+        try:
+            os.makedirs(ASSET_CACHE_DIR, exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=ASSET_CACHE_DIR, delete=False) as cache_file:
+                pickle.dump(asset, cache_file, pickle.HIGHEST_PROTOCOL)
+            os.replace(cache_file.name, cache_path)
+            print('******** cached asset {}'.format(name))
+        except:
+            traceback.print_exc()
+    except:
+        traceback.print_exc()
+        asset = compute()
 
-    if video_width is None:
-        raise Exception('Failed to identify video resolution')
-    #info_stream.close()
-    print('******** identified {}x{} resolution'.format(video_width, video_height))
+    _loaded_assets[key] = asset
+    return asset
 
-    vision_core = vision_core_class(video_width, video_height)
+def iter_frames(frame_stream, video_width, video_height):
+    import PIL.Image
 
+    # Every frame is read into the same buffer instead of a fresh bytes object per frame; PIL
+    # copies RGB data into its own storage, so the images stay valid after the next read.
     frame_size = video_width * video_height * VIDEO_CHANNELS
-    frame_reader = io.BufferedReader(frame_stream)
+    frame_buffer = bytearray(frame_size)
+    frame_view = memoryview(frame_buffer)
+
+    while True:
+        received_size = 0
+        while received_size < frame_size:
+            read_size = frame_stream.readinto(frame_view[received_size:])
+            if not read_size:
+                return
+            received_size += read_size
+        yield PIL.Image.frombuffer('RGB', (video_width, video_height), frame_buffer, 'raw', 'RGB',
+                                   0, 1)
+
+# Smooths the match ids read from individual frames into the current match: the most common id
+# seen since the match started, until no id has been read for MATCH_END_TIMEOUT seconds.
+class MatchTracker:
+    def __init__(self, event_id):
+        self.match_id = None
 
+        self._event_id = event_id
+        self._match_id_counter = collections.Counter()
+        self._end_timestamp = -1
+
+    def update(self, new_match_id, timestamp):
+        # Returns whether the current match id should be reported.
+        if new_match_id is None:
+            if self.match_id is not None:
+                if self._end_timestamp == -1:
+                    self._end_timestamp = timestamp
+                elif timestamp - self._end_timestamp >= MATCH_END_TIMEOUT:
+                    self._end_timestamp = -1
+                    self._match_id_counter.clear()
+                    self.match_id = None
+                    return True
+        elif len(new_match_id) > 0:
+            new_match_id = MATCH_ID_TEMPLATE.format(self._event_id, new_match_id)
+            self._match_id_counter[new_match_id] += 1
+            self.match_id = self._match_id_counter.most_common(1)[0][0]
+            return True
+        return False
+
+def background_process(event_id, game_id, video_width, video_height, overlay_gate, frame_stream,
+                       match_id_queue):
+    # The vision stack (PIL, OpenCV, NumPy, Tesseract) is only imported here, in the worker
+    # process, to keep it off the recorder's startup path.
+    vision_core_class = load_game_plugin(game_id).VISION_CORE_CLASS
+
+    print('******** processing {}x{} frames'.format(video_width, video_height))
+
+    vision_core = vision_core_class(video_width, video_height, overlay_gate=overlay_gate)
+    match_tracker = MatchTracker(event_id)
+
+    logged_match_id = None
+    frames = iter_frames(frame_stream, video_width, video_height)
     while True:
         try:
-            print('reading frame data')
-            data = frame_reader.read(frame_size)
-            if len(data) < frame_size:
+            frame = next(frames, None)
+            if frame is None:
                 break
 
-            print('decoding frame data')
-            frame = PIL.Image.frombuffer('RGB', (video_width, video_height), data, 'raw', 'RGB',
-                                         0, 1)
-
-            print('start processing frame')
             process_start_time = time.time()
             new_match_id, match_info = vision_core.process_frame(frame)
             print('frame_process_time = {}'.format(time.time() - process_start_time))
 
-            if new_match_id is None:
-                if match_id is not None:
-                    if end_timestamp == -1:
-                        end_timestamp = time.time()
-                    elif time.time() - end_timestamp >= MATCH_END_TIMEOUT:
-                        end_timestamp = -1
-                        match_id_counter.clear()
-                        match_id = None
-                        match_id_queue.put(None)
-            elif len(new_match_id) > 0:
-                new_match_id = MATCH_ID_TEMPLATE.format(event_id, new_match_id)
-                match_id_counter[new_match_id] += 1
-                match_id = match_id_counter.most_common(1)[0][0]
-                match_id_queue.put(match_id)
-
-            if match_id is not None:
-                print('{} {}'.format(match_id, match_info))
+            if match_tracker.update(new_match_id, time.time()):
+                match_id_queue.put(match_tracker.match_id)
+
+            # The match info (scores, time left) changes with nearly every frame, so it's only
+            # logged when the match changes.
+            if match_tracker.match_id != logged_match_id:
+                print('{} {}'.format(match_tracker.match_id, match_info))
+                logged_match_id = match_tracker.match_id
         except KeyboardInterrupt:
             raise
         except:
             traceback.print_exc()
 
 class MatchObserver:
-    def __init__(self, event_id, game_id):
+    def __init__(self, event_id, game_id, overlay_gate=False):
         self._event_id = event_id
+        self._game_id = game_id
+        self._overlay_gate = overlay_gate
         self._frame_extractor = None
+        self._background_process = None
+        self._match_id_queue = None
 
-        if game_id == 'FTC-2017':
-            import matchobserver.ftc2017
-            self._vision_core_class = ftc2017.FTC2017VisionCore
-        elif game_id == 'FRC-2017':
-            import matchobserver.frc2017
-            self._vision_core_class = frc2017.FRC2017VisionCore
-        else:
-            raise Exception('Unrecognized game id: ' + game_id)
+        check_game_plugin(game_id)
         print('***** ready for game_id ' + game_id)
 
-    def start(self):
+    def start(self, video_width=DEFAULT_VIDEO_WIDTH, video_height=DEFAULT_VIDEO_HEIGHT):
+        # FFmpeg scales whatever it decodes to the requested size, so the frame size the vision
+        # core sees never depends on guessing the stream's resolution right.
+        ffmpeg_command = [arg.format(video_width, video_height) for arg in FFMPEG_COMMAND]
+
         self._match_id_queue = multiprocessing.Queue()
-        self._frame_extractor = subprocess.Popen(FFMPEG_COMMAND,
+        self._frame_extractor = subprocess.Popen(ffmpeg_command,
                                                  stdin=subprocess.PIPE,
                                                  stdout=subprocess.PIPE,
                                                  #stderr=subprocess.PIPE,
                                                  preexec_fn=os.setpgrp)
 
-        multiprocessing.Process(
+        self._background_process = multiprocessing.Process(
                 target=background_process,
                 args=(self._event_id,
-                      self._vision_core_class,
-                      self._frame_extractor.stderr,
+                      self._game_id,
+                      video_width,
+                      video_height,
+                      self._overlay_gate,
                       self._frame_extractor.stdout,
-                      self._match_id_queue)
-        ).start()
+                      self._match_id_queue))
+        self._background_process.start()
+
+        # Only the background process reads the frames.
+        self._frame_extractor.stdout.close()
 
     def stop(self):
+        # Every connection starts a new FFmpeg and background process, so both have to be reaped
+        # and their pipes closed here, or each reconnect leaks a few file descriptors and zombies.
         if self._frame_extractor is not None:
             self._frame_extractor.terminate()
+            try:
+                self._frame_extractor.stdin.close()
+            except BrokenPipeError:
+                pass
+            try:
+                self._frame_extractor.wait(STOP_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                self._frame_extractor.kill()
+                self._frame_extractor.wait()
             self._frame_extractor = None
-        self._match_id_queue = None
+
+        if self._background_process is not None:
+            # The background process exits on its own once FFmpeg's output ends.
+            self._background_process.join(STOP_TIMEOUT)
+            if self._background_process.is_alive():
+                self._background_process.terminate()
+                self._background_process.join()
+            self._background_process = None
+
+        if self._match_id_queue is not None:
+            self._match_id_queue.close()
+            self._match_id_queue = None
 
     def feed(self, data):
         self._frame_extractor.stdin.write(data)
@@ -29,10 +29,15 @@ import time
 
 import cv2
 import PIL
-import PIL.ImageEnhance
-import PIL.ImageOps
+import PIL.Image
 import pytesseract
 
+import matchobserver
+import matchobserver.overlay
+import matchobserver.preprocess
+
+GAME_ID = 'FRC-2017'
+
 BASE_WIDTH = 1280
 BASE_HEIGHT = 720
 
@@ -64,6 +69,17 @@ MATCH_TIME_RECT = (614-FMS_BASE_X, 606-FMS_BASE_Y, 52+614-FMS_BASE_X, 27+606-FMS
 MATCH_TIME_CONTRAST = 127
 MATCH_TIME_THRESHOLD = 72
 
+# Each variant is only produced if OCR failed on the previous one.
+MATCH_TIME_PIPELINES = [
+    matchobserver.preprocess.Pipeline(('contrast', MATCH_TIME_CONTRAST), ('grayscale',),
+                                      ('threshold', MATCH_TIME_THRESHOLD)),
+    matchobserver.preprocess.Pipeline(('contrast', MATCH_TIME_CONTRAST)),
+    matchobserver.preprocess.Pipeline()
+]
+
+SCORE_PIPELINE = matchobserver.preprocess.Pipeline(('grayscale',), ('invert',))
+NUMBER_PIPELINE = matchobserver.preprocess.Pipeline()
+
 MODE_DISTINGUISH_RECT = (580-FMS_BASE_X, 604-FMS_BASE_Y, 21+580-FMS_BASE_X, 31+604-FMS_BASE_Y)
 
 FIRST_PORTION_COLOR = (222, 188, 146)
@@ -72,6 +88,11 @@ FIRST_PORTION_THRESHOLD = 10
 MATCH_ENDED_COLOR = (236, 54, 11)
 MATCH_ENDED_THRESHOLD = 100
 
+OVERLAY_SIGNATURE = matchobserver.overlay.OverlaySignature(
+        band_rect=(0, BASE_HEIGHT * 3 / 5, BASE_WIDTH, BASE_HEIGHT),
+        colors=[RED_COLOR, BLUE_COLOR], color_threshold=60, min_color_fraction=0.01,
+        edge_threshold=40, min_edge_density=0.01)
+
 AUTON_TIME = 15
 TELEOP_TIME = 135
 
@@ -151,14 +172,26 @@ def read_match_id(label):
                 return fmt.format(match_number)
     return None
 
-def mean_color(img):
-    return cv2.mean(numpy.array(img))[:3]
+def compute_first_logo_template():
+    template = cv2.cvtColor(cv2.imread(FIRST_LOGO_TEMPLATE_PATH), cv2.COLOR_BGR2RGB)
+    template_height, template_width = template.shape[:2]
+    keypoints, descriptors = cv2.xfeatures2d.SURF_create().detectAndCompute(template, None)
+    # cv2.KeyPoint objects can't be pickled, and only their positions are used for matching.
+    keypoint_points = numpy.float32([keypoint.pt for keypoint in keypoints])
+    return (template_width, template_height, keypoint_points, descriptors)
+
+def mean_color(array):
+    return tuple(array.mean(axis=(0, 1))[:3])
+
+def crop_array(frame_array, rect):
+    x1, y1, x2, y2 = (int(round(coord)) for coord in rect)
+    return frame_array[max(0, y1):max(0, y2), max(0, x1):max(0, x2)]
 
 def color_dist(color1, color2):
     return scipy.spatial.distance.euclidean(color1, color2)
 
 class FRC2017VisionCore:
-    def __init__(self, video_width, video_height, advanced_scraping=False):
+    def __init__(self, video_width, video_height, advanced_scraping=False, overlay_gate=False):
         self._advanced_scraping = advanced_scraping
 
         self._x_scale = video_width / BASE_WIDTH
@@ -167,26 +200,39 @@ class FRC2017VisionCore:
             [(x1 * self._x_scale, y1 * self._y_scale, x2 * self._x_scale, y2 * self._y_scale)
                 for x1, y1, x2, y2 in MATCH_LABEL_RECTS]
 
+        self._overlay_detector = None
+        if overlay_gate:
+            self._overlay_detector = matchobserver.overlay.OverlayDetector(
+                    OVERLAY_SIGNATURE, video_width, video_height, BASE_WIDTH, BASE_HEIGHT)
+
         self._half_video_width = video_width / 2
         self._label_x2 = self._half_video_width - MATCH_LABEL_RIGHT_PADDING
 
-        template = cv2.cvtColor(cv2.imread(FIRST_LOGO_TEMPLATE_PATH), cv2.COLOR_BGR2RGB)
-        self._template_height, self._template_width = template.shape[:2]
+        self._template_width, self._template_height, self._template_points, \
+            self._template_descriptors = \
+                matchobserver.load_cached_asset('frc2017-first-logo-{}'.format(cv2.__version__),
+                                                [FIRST_LOGO_TEMPLATE_PATH],
+                                                compute_first_logo_template)
         self._feature_detector = cv2.xfeatures2d.SURF_create()
         self._flann_matcher = cv2.FlannBasedMatcher(*FIRST_LOGO_FLANN_PARAMS)
-        self._template_keypoints, self._template_descriptors = \
-            self._feature_detector.detectAndCompute(template, None)
 
     def process_frame(self, frame):
+        # Crops are taken as views of one array of the frame, and preprocessed with NumPy.
+        frame_array = numpy.asarray(frame)
+
+        if self._overlay_detector is not None and not self._overlay_detector.present(frame_array):
+            return (None, {})
+
         candidate_label_rects = self._scaled_label_rects
 
-        found_rect = self._find_label_rect(frame)
+        found_rect = self._find_label_rect(frame_array)
         print('found_rect = {}'.format(found_rect))
         if found_rect is not None:
             candidate_label_rects = [found_rect] + candidate_label_rects
 
         candidate_match_ids = \
-            ((read_match_id(frame.crop(rect)), rect) for rect in candidate_label_rects)
+            ((read_match_id(PIL.Image.fromarray(crop_array(frame_array, rect))), rect)
+                for rect in candidate_label_rects)
 
         match_id = None
         label_rect = None
@@ -197,46 +243,43 @@ class FRC2017VisionCore:
                 break
 
         if match_id is not None:
-            timeout_dist = color_dist(mean_color(self._crop_rel(frame, label_rect, TIMEOUT_RECT)),
-                                      TIMEOUT_COLOR)
+            timeout_dist = color_dist(
+                    mean_color(self._crop_rel(frame_array, label_rect, TIMEOUT_RECT)),
+                    TIMEOUT_COLOR)
             if timeout_dist < TIMEOUT_THRESHOLD:
                 print('timeout detected')
                 match_id = None
 
         match_info = {}
         if self._advanced_scraping and match_id is not None:
-            left_color_img = self._crop_rel(frame, label_rect, LEFT_COLOR_RECT)
-            left_mean_color = mean_color(left_color_img)
+            def read_field(rect, pipeline):
+                crop = self._crop_rel(frame_array, label_rect, rect)
+                return read_number(pipeline.apply_image(crop))
+
+            left_mean_color = mean_color(self._crop_rel(frame_array, label_rect, LEFT_COLOR_RECT))
             left_red_dist = color_dist(left_mean_color, RED_COLOR)
             left_blue_dist = color_dist(left_mean_color, BLUE_COLOR)
 
             left_team = 'red' if left_red_dist < left_blue_dist else 'blue'
             right_team = 'blue' if left_team == 'red' else 'red'
 
-            left_score_img = \
-                PIL.ImageOps.invert(self._crop_rel(frame, label_rect, LEFT_SCORE_RECT).convert('L'))
-            right_score_img = \
-                PIL.ImageOps.invert(self._crop_rel(frame, label_rect, RIGHT_SCORE_RECT).convert('L'))
-
-            match_info['{}_score'.format(left_team)] = read_number(left_score_img)
-            match_info['{}_score'.format(right_team)] = read_number(right_score_img)
+            match_info['{}_score'.format(left_team)] = read_field(LEFT_SCORE_RECT, SCORE_PIPELINE)
+            match_info['{}_score'.format(right_team)] = \
+                read_field(RIGHT_SCORE_RECT, SCORE_PIPELINE)
 
-            match_info['{}_hangs'.format(left_team)] = \
-                read_number(self._crop_rel(frame, label_rect, LEFT_HANGS_RECT))
+            match_info['{}_hangs'.format(left_team)] = read_field(LEFT_HANGS_RECT, NUMBER_PIPELINE)
             match_info['{}_rotors'.format(left_team)] = \
-                read_number(self._crop_rel(frame, label_rect, LEFT_ROTORS_RECT))
-            match_info['{}_kpa'.format(left_team)] = \
-                read_number(self._crop_rel(frame, label_rect, LEFT_KPA_RECT))
+                read_field(LEFT_ROTORS_RECT, NUMBER_PIPELINE)
+            match_info['{}_kpa'.format(left_team)] = read_field(LEFT_KPA_RECT, NUMBER_PIPELINE)
 
             match_info['{}_hangs'.format(right_team)] = \
-                read_number(self._crop_rel(frame, label_rect, RIGHT_HANGS_RECT))
+                read_field(RIGHT_HANGS_RECT, NUMBER_PIPELINE)
             match_info['{}_rotors'.format(right_team)] = \
-                read_number(self._crop_rel(frame, label_rect, RIGHT_ROTORS_RECT))
-            match_info['{}_kpa'.format(right_team)] = \
-                read_number(self._crop_rel(frame, label_rect, RIGHT_KPA_RECT))
+                read_field(RIGHT_ROTORS_RECT, NUMBER_PIPELINE)
+            match_info['{}_kpa'.format(right_team)] = read_field(RIGHT_KPA_RECT, NUMBER_PIPELINE)
 
             mode_distinguish_color = \
-                mean_color(self._crop_rel(frame, label_rect, MODE_DISTINGUISH_RECT))
+                mean_color(self._crop_rel(frame_array, label_rect, MODE_DISTINGUISH_RECT))
 
             first_portion_dist = color_dist(mode_distinguish_color, FIRST_PORTION_COLOR)
             first_portion = first_portion_dist < FIRST_PORTION_THRESHOLD
@@ -248,25 +291,12 @@ class FRC2017VisionCore:
                 match_info['match_period'] = 'ended'
                 match_info['match_time'] = 0
             else:
-                match_time_img = self._crop_rel(frame, label_rect, MATCH_TIME_RECT)
-                #match_time_img.save('a.png')
-
-                match_time_enhanced = \
-                    PIL.ImageEnhance.Contrast(match_time_img).enhance(MATCH_TIME_CONTRAST)
-                #match_time_enhanced.save('b.png')
-
-                match_time_thresholded = \
-                    match_time_enhanced \
-                        .convert('L') \
-                        .point(lambda x: 0 if x < MATCH_TIME_THRESHOLD else 255, '1')
-                #match_time_thresholded.save('c.png')
-
                 match_period = 'teleop'
-                match_time = read_number(match_time_thresholded)
-                if match_time is None:
-                    match_time = read_number(match_time_enhanced)
-                if match_time is None:
-                    match_time = read_number(match_time_img)
+                match_time = None
+                for pipeline in MATCH_TIME_PIPELINES:
+                    match_time = read_field(MATCH_TIME_RECT, pipeline)
+                    if match_time is not None:
+                        break
 
                 if match_time == 0:
                     match_info['match_period'] = None
@@ -280,7 +310,7 @@ class FRC2017VisionCore:
 
         return (match_id, match_info)
 
-    def _crop_rel(self, frame, origin_rect, rel_rect):
+    def _crop_rel(self, frame_array, origin_rect, rel_rect):
         ox1, oy1, ox2, oy2 = origin_rect
         rx1, ry1, rx2, ry2 = rel_rect
 
@@ -289,12 +319,13 @@ class FRC2017VisionCore:
         x2 = rx2 * self._x_scale + self._half_video_width
         y2 = ry2 * self._y_scale + oy1
 
-        return frame.crop((x1, y1, x2, y2))
+        return crop_array(frame_array, (x1, y1, x2, y2))
 
-    def _find_label_rect(self, frame):
-        frame_crop = (0, 0, frame.width * FIRST_LOGO_SCAN_RATIO, frame.height)
-        frame_array = numpy.array(frame.crop(frame_crop))
-        keypoints, descriptors = self._feature_detector.detectAndCompute(frame_array, None)
+    def _find_label_rect(self, frame_array):
+        frame_height, frame_width = frame_array.shape[:2]
+        scan_array = numpy.ascontiguousarray(
+                crop_array(frame_array, (0, 0, frame_width * FIRST_LOGO_SCAN_RATIO, frame_height)))
+        keypoints, descriptors = self._feature_detector.detectAndCompute(scan_array, None)
 
         if descriptors is None:
             print('no descriptors')
@@ -309,7 +340,7 @@ class FRC2017VisionCore:
                 good_matches.append(m)
 
         if len(good_matches) > FIRST_LOGO_MIN_MATCH_COUNT:
-            src_pts = numpy.float32([self._template_keypoints[m.queryIdx].pt for m in good_matches]).reshape(-1,1,2)
+            src_pts = self._template_points[[m.queryIdx for m in good_matches]].reshape(-1,1,2)
             dst_pts = numpy.float32([keypoints[m.trainIdx].pt for m in good_matches]).reshape(-1,1,2)
 
             t = cv2.estimateRigidTransform(src_pts, dst_pts, False)
@@ -323,6 +354,8 @@ class FRC2017VisionCore:
 
         return None
 
+VISION_CORE_CLASS = FRC2017VisionCore
+
 if __name__ == '__main__':
     vision_core = FRC2017VisionCore(BASE_WIDTH, BASE_HEIGHT)
 
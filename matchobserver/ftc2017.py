@@ -25,9 +25,14 @@ import re
 import sys
 import time
 
+import numpy
 import PIL
 import pytesseract
 
+import matchobserver.overlay
+
+GAME_ID = 'FTC-2017'
+
 BASE_WIDTH = 1280
 BASE_HEIGHT = 720
 
@@ -35,6 +40,10 @@ MATCH_LABEL_RECTS = [(351, 577, 351+247, 577+108)]
 
 MATCH_LABEL_TESSERACT_CONFIG = '-psm 7'
 
+OVERLAY_SIGNATURE = matchobserver.overlay.OverlaySignature(
+        band_rect=(0, 560, BASE_WIDTH, BASE_HEIGHT), colors=[], color_threshold=0,
+        min_color_fraction=0, edge_threshold=40, min_edge_density=0.02)
+
 NUMBER_PATTERN = '0-9ZSO'
 def np(r):
     return r.replace('@', NUMBER_PATTERN)
@@ -68,7 +77,12 @@ def read_match_id(label):
     return None
 
 class FTC2017VisionCore:
-    def __init__(self, video_width, video_height):
+    def __init__(self, video_width, video_height, advanced_scraping=False, overlay_gate=False):
+        self._overlay_detector = None
+        if overlay_gate:
+            self._overlay_detector = matchobserver.overlay.OverlayDetector(
+                    OVERLAY_SIGNATURE, video_width, video_height, BASE_WIDTH, BASE_HEIGHT)
+
         x_scale = video_width / BASE_WIDTH
         y_scale = video_height / BASE_HEIGHT
         self._scaled_label_rects = \
@@ -76,6 +90,10 @@ class FTC2017VisionCore:
                 for x1, y1, x2, y2 in MATCH_LABEL_RECTS]
 
     def process_frame(self, frame):
+        if self._overlay_detector is not None and \
+           not self._overlay_detector.present(numpy.asarray(frame)):
+            return (None, {})
+
         candidate_match_ids = \
             (read_match_id(frame.crop(rect)) for rect in self._scaled_label_rects)
 
@@ -87,6 +105,7 @@ class FTC2017VisionCore:
 
         return (match_id, {})
 
+VISION_CORE_CLASS = FTC2017VisionCore
 
 if __name__ == '__main__':
     vision_core = FTC2017VisionCore(BASE_WIDTH, BASE_HEIGHT)
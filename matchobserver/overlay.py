@@ -0,0 +1,94 @@
+# vim: set tw=99:
+
+# This file is part of FRC Replay, a system for automatically recording match
+# videos from live streams of FIRST games.
+
+# Copyright (C) 2017 Michael Smith <michael@spinda.net>
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+
+# You should have received a copy of the GNU Affero General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+
+import numpy
+
+# Describes what the match overlay looks like, in a VisionCore's base resolution: the band of the
+# frame it occupies, colors that cover at least min_color_fraction of that band whenever it's on
+# screen, and the minimum fraction of the band's pixels that sit on an edge (text, borders).
+OverlaySignature = collections.namedtuple('OverlaySignature', [
+    'band_rect', 'colors', 'color_threshold', 'min_color_fraction', 'edge_threshold',
+    'min_edge_density'
+])
+
+# Sample spacing in base resolution pixels; at 1280x720 a full-width band is 160 samples wide.
+OVERLAY_SAMPLE_STRIDE = 8
+
+# About every five minutes at the match detector's frame rate.
+OVERLAY_REPORT_INTERVAL = 100
+
+# Cheaply tells whether the overlay is on screen at all, from a subsampled view of its band, so
+# that frames without it never reach OCR. A frame it misses is reported as having no match, which
+# ends the current recording once MatchTracker times out, so vision cores only use it when asked
+# to, and a signature should be checked with benchmarks/visioncore.py --overlay-gate first.
+class OverlayDetector:
+    def __init__(self, signature, video_width, video_height, base_width, base_height):
+        x_scale = video_width / base_width
+        y_scale = video_height / base_height
+        x1, y1, x2, y2 = signature.band_rect
+        x_stride = max(1, int(round(OVERLAY_SAMPLE_STRIDE * x_scale)))
+        y_stride = max(1, int(round(OVERLAY_SAMPLE_STRIDE * y_scale)))
+        self._band = (slice(int(y1 * y_scale), int(y2 * y_scale), y_stride),
+                      slice(int(x1 * x_scale), int(x2 * x_scale), x_stride))
+
+        self._colors = numpy.array(signature.colors, dtype=numpy.int32).reshape(-1, 1, 1, 3)
+        self._color_threshold_sq = signature.color_threshold ** 2
+        self._min_color_fraction = signature.min_color_fraction
+        # Edges are found on the sum of the channels, so scale the per-channel threshold to it.
+        self._edge_threshold = signature.edge_threshold * 3
+        self._min_edge_density = signature.min_edge_density
+
+        self.frames_checked = 0
+        self.frames_skipped = 0
+
+    def present(self, frame_array):
+        present = self._check(frame_array)
+
+        self.frames_checked += 1
+        if not present:
+            self.frames_skipped += 1
+        if self.frames_checked % OVERLAY_REPORT_INTERVAL == 0:
+            print('******** overlay missing from {} of {} frames, skip ratio = {:.2f}'.format(
+                  self.frames_skipped, self.frames_checked, self.skip_ratio()))
+        return present
+
+    def _check(self, frame_array):
+        band = frame_array[self._band].astype(numpy.int32)
+
+        if len(self._colors) > 0:
+            color_dist_sq = ((band[numpy.newaxis, ..., :3] - self._colors) ** 2).sum(axis=3)
+            color_fraction = (color_dist_sq.min(axis=0) < self._color_threshold_sq).mean()
+            if color_fraction < self._min_color_fraction:
+                return False
+
+        if self._min_edge_density > 0:
+            intensity = band[..., :3].sum(axis=2)
+            edge_density = (numpy.abs(numpy.diff(intensity, axis=1)) > self._edge_threshold).mean()
+            if edge_density < self._min_edge_density:
+                return False
+
+        return True
+
+    def skip_ratio(self):
+        if self.frames_checked == 0:
+            return 0
+        return self.frames_skipped / self.frames_checked
@@ -0,0 +1,114 @@
+# vim: set tw=99:
+
+# This file is part of FRC Replay, a system for automatically recording match
+# videos from live streams of FIRST games.
+
+# Copyright (C) 2017 Michael Smith <michael@spinda.net>
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+
+# You should have received a copy of the GNU Affero General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import numpy
+import PIL.Image
+
+# Declarative image preprocessing for OCR crops. A pipeline is a list of steps such as
+# ('grayscale',), ('contrast', 127), ('threshold', 72), ('invert',) and ('upscale', 2). It is
+# compiled once into lookup tables and vectorized NumPy operations that reproduce the results of
+# the equivalent PIL calls (convert('L'), ImageEnhance.Contrast, point and ImageOps.invert).
+
+# PIL's ITU-R 601-2 luma transform in 16-bit fixed point: L = R * 299/1000 + G * 587/1000 +
+# B * 114/1000.
+GRAYSCALE_LUTS = [numpy.arange(256, dtype=numpy.uint32) * weight
+                  for weight in (19595, 38470, 7471)]
+GRAYSCALE_ROUNDING = 0x8000
+
+IDENTITY_LUT = numpy.arange(256, dtype=numpy.uint8)
+
+def threshold_lut(threshold):
+    return numpy.where(IDENTITY_LUT < threshold, 0, 255).astype(numpy.uint8)
+
+def invert_lut():
+    return 255 - IDENTITY_LUT
+
+def contrast_lut(mean, factor):
+    # ImageEnhance.Contrast blends the image with a solid image of its mean luma; PIL clips and
+    # truncates the blended values.
+    return numpy.clip(mean + factor * (IDENTITY_LUT.astype(numpy.float64) - mean),
+                      0, 255).astype(numpy.uint8)
+
+def grayscale(array):
+    if array.ndim == 2:
+        return array
+    luma = GRAYSCALE_LUTS[0][array[..., 0]]
+    luma += GRAYSCALE_LUTS[1][array[..., 1]]
+    luma += GRAYSCALE_LUTS[2][array[..., 2]]
+    luma += GRAYSCALE_ROUNDING
+    return (luma >> 16).astype(numpy.uint8)
+
+def mean_luma(array):
+    return int(grayscale(array).mean() + 0.5)
+
+class Pipeline:
+    def __init__(self, *steps):
+        self.steps = steps
+        self._ops = []
+
+        # Pixel-wise steps with fixed tables are folded into a single table.
+        for step in steps:
+            name, args = step[0], step[1:]
+            if name == 'grayscale':
+                self._ops.append(('grayscale',))
+            elif name == 'contrast':
+                self._ops.append(('contrast', args[0]))
+            elif name == 'threshold':
+                self._append_lut(threshold_lut(args[0]))
+            elif name == 'invert':
+                self._append_lut(invert_lut())
+            elif name == 'upscale':
+                self._ops.append(('upscale', args[0]))
+            else:
+                raise Exception('Unrecognized preprocessing step: ' + name)
+
+    def _append_lut(self, lut):
+        if len(self._ops) > 0 and self._ops[-1][0] == 'lut':
+            lut = lut[self._ops[-1][1]]
+            self._ops.pop()
+        self._ops.append(('lut', lut))
+
+    def apply(self, array):
+        lut = None
+        for op in self._ops:
+            if op[0] == 'lut':
+                lut = op[1] if lut is None else op[1][lut]
+                continue
+            if op[0] == 'contrast':
+                # The contrast table depends on the crop's mean, so it is built per crop.
+                if lut is not None:
+                    array = lut[array]
+                lut = contrast_lut(mean_luma(array), op[1])
+                continue
+
+            if lut is not None:
+                array = lut[array]
+                lut = None
+            if op[0] == 'grayscale':
+                array = grayscale(array)
+            elif op[0] == 'upscale':
+                array = array.repeat(op[1], axis=0).repeat(op[1], axis=1)
+
+        if lut is not None:
+            array = lut[array]
+        return array
+
+    def apply_image(self, array):
+        return PIL.Image.fromarray(numpy.ascontiguousarray(self.apply(array)))
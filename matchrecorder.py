@@ -20,25 +20,41 @@
 # You should have received a copy of the GNU Affero General Public License along
 # with this program. If not, see <http://www.gnu.org/licenses/>.
 
-import collections
 import datetime
 import multiprocessing
 import os
-import tempfile
+import threading
 import time
 import traceback
 
 import matchobserver
+import memorymonitor
+import recordingjournal
+import recordingwriter
+import rollingarchive
 import streamconnector
+import twitterposter
 import videohandler
 
-PREMATCH_BUFFER_CHUNKS = 2048
+PREMATCH_TIME = 20
 SPLIT_AT_TIME = 60 * 8
 
-VIDEOS_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'videos')
+ARCHIVE_SEGMENT_DURATION = 10
+ARCHIVE_MAX_BYTES = 4 * 1024 * 1024 * 1024
+ARCHIVE_FSYNC_POLICY = recordingwriter.FSYNC_ON_CLOSE
+
+VIDEOS_DIR = videohandler.VIDEOS_DIR
+ARCHIVE_DIR = os.path.join(VIDEOS_DIR, 'archive')
 RECORDING_DIR = os.path.join(VIDEOS_DIR, 'recording')
+RECORDING_FORMAT = os.path.join(RECORDING_DIR, '{}.mp4')
 READY_DIR = os.path.join(VIDEOS_DIR, 'ready')
 READY_FORMAT = os.path.join(READY_DIR, '{}---{}')
+JOURNAL_PATH = os.path.join(VIDEOS_DIR, 'recording.journal')
+
+RECORDING_ID_FORMAT = '{:.3f}'
+RESUME_TIMEOUT = 120
+
+READY_SCAN_INTERVAL = 60
 
 os.makedirs(RECORDING_DIR, exist_ok=True)
 os.makedirs(READY_DIR, exist_ok=True)
@@ -46,44 +62,99 @@ os.makedirs(READY_DIR, exist_ok=True)
 TITLE_FORMAT = '[{}] {}'
 
 class MatchRecorderStreamConnector(streamconnector.StreamConnector):
-    def __init__(self, event_id, twitch_id, twitter_user, game_id):
-        super().__init__(event_id, twitch_id)
+    def __init__(self, event_id, twitch_id, twitter_user, game_id, detector_quality=None,
+                 stream_url=None, warm_standby=False, overlay_gate=False):
+        super().__init__(event_id, twitch_id, detector_quality, stream_url, warm_standby)
         self._twitter_user = twitter_user
         self._game_id = game_id
-        self._match_observer = matchobserver.MatchObserver(event_id, game_id)
-
-    def on_connecting(self):
-        self._match_id = None
-        self._match_video = None
-
-        self._last_timestamp = 0
-        self._recording_timestamp = -1
-
-        self._prematch_buffer = collections.deque(maxlen=PREMATCH_BUFFER_CHUNKS)
-
+        self._match_observer = matchobserver.MatchObserver(event_id, game_id, overlay_gate)
+        self._journal = recordingjournal.RecordingJournal(JOURNAL_PATH)
+        self._archive = rollingarchive.RollingArchive(ARCHIVE_DIR, ARCHIVE_SEGMENT_DURATION,
+                                                      ARCHIVE_MAX_BYTES, ARCHIVE_FSYNC_POLICY)
+        self._archive_pin = None
+        self._retry_pins = {}
+        self._extracting_ids = set()
+        self._upload_processes = {}
+        self._uploads_lock = threading.Lock()
+
+        self._twitter_poster = twitterposter.TwitterPoster()
+        self._twitter_poster.start()
+
+        self._resumable = None
+        self._resume_deadline = -1
+
+    def on_start(self):
+        # Clips that were being cut when the process died are cut again from the journal.
         for recording_filename in os.listdir(RECORDING_DIR):
             try:
                 os.unlink(os.path.join(RECORDING_DIR, recording_filename))
             except:
                 traceback.print_exc()
 
-        for ready_filename in sorted(os.listdir(READY_DIR)):
-            self._upload_in_background(os.path.join(READY_DIR, ready_filename))
+        threading.Thread(target=self._scan_ready_dir, daemon=True).start()
+
+    def on_connecting(self):
+        self._match_id = None
+        self._recording = None
+        self._recording_timestamp = -1
+
+        # Everything in the archive so far was recorded before this connection, so that's where
+        # a suspended recording ends unless it's continued.
+        archive_end_time = self._archive.end_time()
+
+        self._resumable = None
+        for entry in sorted(self._journal.entries(), key=lambda entry: entry['start_time']):
+            if entry['id'] in self._extracting_ids:
+                continue
+            if archive_end_time is None:
+                self._release_retry_pin(entry['id'])
+                self._journal.remove(entry['id'])
+                continue
+
+            # A recording that was finished but whose clip couldn't be cut is cut again.
+            if 'end_time' in entry:
+                self._finish_recording(entry, entry['end_time'])
+                continue
+
+            # Only the latest recording can still be continued; anything older, or anything that
+            # has sat untouched for too long, is finished as it is.
+            if self._resumable is not None:
+                self._finish_recording(self._resumable, self._resumable['end_time'])
+            entry['end_time'] = archive_end_time
+            self._resumable = entry
+            if time.time() - archive_end_time >= RESUME_TIMEOUT:
+                self._finish_recording(self._resumable, archive_end_time)
+                self._resumable = None
+
+        self._pin_archive(self._resumable['start_time'] if self._resumable else None)
 
     def on_connected(self):
-        self._match_observer.start()
+        self._match_observer.start(*self.detector_resolution)
+        if self._resumable is not None:
+            self._resume_deadline = time.time() + RESUME_TIMEOUT
 
     def on_disconnected(self):
         self._match_observer.stop()
-        self._handle_match_video()
+        self._archive.flush()
+
+        # Leave the recording in the journal so that the next connection can pick it back up.
+        if self._recording is not None:
+            print('******** suspended recording video for match {}'.format(self._match_id))
 
         self._match_id = None
-        self._match_video = None
+        self._recording = None
         self._recording_timestamp = -1
 
-    def on_data(self, data):
+    def on_detector_data(self, data):
         self._match_observer.feed(data)
 
+    def on_data(self, data):
+        timestamp = time.time()
+        self._archive.write(data, timestamp)
+
+        if not self.detector_stream_open:
+            self._match_observer.feed(data)
+
         update_recording_state = False
 
         new_match_id = None
@@ -91,10 +162,18 @@ class MatchRecorderStreamConnector(streamconnector.StreamConnector):
             new_match_id = self._match_observer.get_latest()
             update_recording_state = new_match_id != self._match_id
 
+        if self._resumable is not None:
+            resume_abandoned = update_recording_state and \
+                               new_match_id != self._resumable['match_id']
+            if resume_abandoned or timestamp >= self._resume_deadline:
+                self._finish_recording(self._resumable, self._resumable['end_time'])
+                self._resumable = None
+                self._pin_archive(None)
+
         needs_split = self._match_id and \
                       (not update_recording_state or self._match_id == new_match_id) and \
                       self._recording_timestamp != -1 and \
-                      time.time() - self._recording_timestamp >= SPLIT_AT_TIME
+                      timestamp - self._recording_timestamp >= SPLIT_AT_TIME
         if needs_split:
             update_recording_state = True
             new_match_id = self._match_id
@@ -106,46 +185,123 @@ class MatchRecorderStreamConnector(streamconnector.StreamConnector):
                 else:
                     print('******** stopped recording video for match {}'.format(self._match_id))
 
-                self._handle_match_video()
+                self._finish_recording(self._recording, timestamp)
+                self._pin_archive(None)
 
                 self._match_id = None
-                self._match_video = None
+                self._recording = None
                 self._recording_timestamp = -1
 
             if new_match_id is not None:
                 self._match_id = new_match_id
-                self._match_video = tempfile.NamedTemporaryFile(suffix='.mp4', dir=RECORDING_DIR,
-                                                                delete=False)
-                self._recording_timestamp = time.time()
-
-                for chunk in self._prematch_buffer:
-                    self._match_video.write(chunk)
-                self._prematch_buffer.clear()
-
-                print('******** started recording video for match {}'.format(self._match_id))
-
-        if self._match_video:
-            self._match_video.write(data)
-        self._prematch_buffer.append(data)
 
-    def _handle_match_video(self):
-        if self._match_id is None or self._match_video is None:
-            return
-
-        self._match_video.close()
-
-        title = TITLE_FORMAT.format(datetime.date.today().isoformat(), self._match_id)
-        ready_path = READY_FORMAT.format(int(time.time()), title)
-        os.rename(self._match_video.name, ready_path)
-
-        self._upload_in_background(ready_path)
+                if self._resumable is not None:
+                    self._recording = self._resumable
+                    self._resumable = None
+                    print('******** resumed recording video for match {}'.format(self._match_id))
+                else:
+                    # A split picks up exactly where the previous part ended.
+                    start_time = timestamp if needs_split else timestamp - PREMATCH_TIME
+                    recording_id = RECORDING_ID_FORMAT.format(start_time)
+                    self._journal.start(recording_id, self._match_id, start_time)
+                    self._recording = {'id': recording_id, 'match_id': self._match_id,
+                                       'start_time': start_time}
+                    print('******** started recording video for match {}'.format(self._match_id))
+
+                self._recording_timestamp = self._recording['start_time']
+                self._pin_archive(self._recording['start_time'])
+
+    def _pin_archive(self, start_time):
+        # Keeps the archive from evicting the segments of the recording in progress.
+        if self._archive_pin is not None:
+            self._archive.unpin(self._archive_pin)
+        self._archive_pin = start_time
+        if start_time is not None:
+            self._archive.pin(start_time)
+
+    def _release_retry_pin(self, recording_id):
+        start_time = self._retry_pins.pop(recording_id, None)
+        if start_time is not None:
+            self._archive.unpin(start_time)
+
+    def _finish_recording(self, recording, end_time):
+        recording_id = recording['id']
+        match_id = recording['match_id']
+        start_time = recording['start_time']
+
+        self._journal.finish(recording_id, end_time)
+
+        def on_extracted(recording_path):
+            try:
+                title = TITLE_FORMAT.format(datetime.date.fromtimestamp(start_time).isoformat(),
+                                            match_id)
+                ready_path = READY_FORMAT.format(int(time.time()), title)
+                os.rename(recording_path, ready_path)
+                self._journal.remove(recording_id)
+            finally:
+                self._extracting_ids.discard(recording_id)
+
+            self._upload_in_background(ready_path)
+
+        def on_failed(recording_path, retryable):
+            if retryable:
+                # The journal entry stays, so the clip is cut again on the next connection, and
+                # its segments stay pinned until then.
+                print('******** failed to cut video for match {}; will retry'.format(match_id))
+                self._archive.pin(start_time)
+                self._retry_pins[recording_id] = start_time
+            else:
+                print('******** dropping video for match {}'.format(match_id))
+                self._journal.remove(recording_id)
+            self._extracting_ids.discard(recording_id)
+
+        self._extracting_ids.add(recording_id)
+        self._archive.extract_clip(start_time, end_time, RECORDING_FORMAT.format(recording_id),
+                                   on_extracted, on_failed)
+        # extract_clip pinned the clip itself, so a pin held over from a failed attempt can go.
+        self._release_retry_pin(recording_id)
+
+    def _scan_ready_dir(self):
+        # Besides the recorder's own clips, READY_DIR picks up ones left over from before a restart
+        # and ones dropped in from outside, e.g. by vodbackfill.py, so it's checked periodically.
+        while True:
+            try:
+                for ready_filename in sorted(os.listdir(READY_DIR)):
+                    self._upload_in_background(os.path.join(READY_DIR, ready_filename))
+            except:
+                traceback.print_exc()
+            time.sleep(READY_SCAN_INTERVAL)
 
     def _upload_in_background(self, ready_path):
-        multiprocessing.Process(
-                target=videohandler.upload_to_streamable_and_post_to_twitter,
-                args=(ready_path.split('---')[1], ready_path, self._twitter_user)
-        ).start()
+        with self._uploads_lock:
+            # An upload deletes its clip before it exits, so once it's reaped, a clip that's still
+            # there needs uploading again.
+            self._reap_uploads()
+            if ready_path in self._upload_processes or not os.path.exists(ready_path):
+                return
+
+            upload_process = multiprocessing.Process(
+                    target=videohandler.upload_to_streamable_and_queue_tweet,
+                    args=(ready_path.split('---')[1], ready_path, self._twitter_user))
+            upload_process.start()
+            self._upload_processes[ready_path] = upload_process
+
+    def _reap_uploads(self):
+        # Joins finished uploads, so that a weekend of them doesn't pile up as zombie processes.
+        for ready_path, upload_process in list(self._upload_processes.items()):
+            if not upload_process.is_alive():
+                del self._upload_processes[ready_path]
+
+    def pending_uploads(self):
+        # Counts the clips still being cut or uploaded.
+        with self._uploads_lock:
+            self._reap_uploads()
+            return len(self._extracting_ids) + len(self._upload_processes)
 
 if __name__ == '__main__':
+    memorymonitor.MemoryMonitor(on_sample=recordingwriter.log_recent_latencies).start()
     MatchRecorderStreamConnector(os.environ['EVENT_ID'], os.environ['TWITCH_ID'],
-                                 os.environ['TWITTER_USER'], os.environ['GAME_ID']).run()
+                                 os.environ['TWITTER_USER'], os.environ['GAME_ID'],
+                                 os.environ.get('DETECTOR_QUALITY'), os.environ.get('STREAM_URL'),
+                                 os.environ.get('WARM_STANDBY') == '1',
+                                 os.environ.get('OVERLAY_GATE') == '1').run()
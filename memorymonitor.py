@@ -0,0 +1,131 @@
+# vim: set tw=99:
+
+# This file is part of FRC Replay, a system for automatically recording match
+# videos from live streams of FIRST games.
+
+# Copyright (C) 2017 Michael Smith <michael@spinda.net>
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+
+# You should have received a copy of the GNU Affero General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import signal
+import threading
+import time
+import traceback
+import tracemalloc
+
+MEMORY_SAMPLE_INTERVAL = 5 * 60
+SNAPSHOT_SIGNAL = signal.SIGUSR1
+SNAPSHOT_TRACE_FRAMES = 10
+SNAPSHOT_TOP_COUNT = 15
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+def rss_bytes():
+    with open('/proc/self/statm', 'r') as statm_file:
+        return int(statm_file.read().split()[1]) * PAGE_SIZE
+
+def fd_count():
+    return len(os.listdir('/proc/self/fd'))
+
+def child_count():
+    # Counted from /proc rather than from multiprocessing, so that FFmpeg subprocesses and
+    # children that have exited but were never reaped show up too.
+    pid = os.getpid()
+    count = 0
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open(os.path.join('/proc', name, 'stat'), 'r') as stat_file:
+                stat = stat_file.read()
+        except OSError:
+            continue
+        # The command name in parentheses may contain spaces, so split after it.
+        if int(stat[stat.rindex(')') + 2:].split()[1]) == pid:
+            count += 1
+    return count
+
+def sample():
+    traced_bytes, traced_peak_bytes = tracemalloc.get_traced_memory()
+    return {'rss': rss_bytes(), 'fds': fd_count(), 'children': child_count(),
+            'traced': traced_bytes, 'traced_peak': traced_peak_bytes}
+
+def take_snapshot():
+    return tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__)
+    ])
+
+def format_sample(memory_sample):
+    line = 'rss {:.1f} MiB, {} fds, {} children'.format(memory_sample['rss'] / 1024 / 1024,
+                                                        memory_sample['fds'],
+                                                        memory_sample['children'])
+    if tracemalloc.is_tracing():
+        line += ', traced {:.1f} MiB (peak {:.1f} MiB)'.format(
+                memory_sample['traced'] / 1024 / 1024, memory_sample['traced_peak'] / 1024 / 1024)
+    return line
+
+# Logs the process's memory, file descriptor and child process counts at a fixed interval. Sending
+# the process SIGUSR1 starts tracemalloc on the first signal and, on every later one, logs the
+# allocation sites that grew the most since the previous signal. on_sample, if given, is called
+# after each sample is logged, to log other periodic stats alongside it.
+class MemoryMonitor:
+    def __init__(self, sample_interval=MEMORY_SAMPLE_INTERVAL, on_sample=None):
+        self.sample_interval = sample_interval
+        self._on_sample = on_sample
+        self._snapshot = None
+        self._snapshot_requested = threading.Event()
+
+    def start(self):
+        # Signal handlers can only be installed from the main thread.
+        signal.signal(SNAPSHOT_SIGNAL, lambda signum, frame: self._snapshot_requested.set())
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        next_sample_time = time.time()
+        while True:
+            if self._snapshot_requested.wait(max(next_sample_time - time.time(), 0)):
+                self._snapshot_requested.clear()
+                try:
+                    self.diff_snapshot()
+                except:
+                    traceback.print_exc()
+            else:
+                print('******** memory: {}'.format(format_sample(sample())))
+                if self._on_sample is not None:
+                    try:
+                        self._on_sample()
+                    except:
+                        traceback.print_exc()
+                next_sample_time += self.sample_interval
+
+    def diff_snapshot(self):
+        # Returns the statistics that were logged, largest growth first.
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(SNAPSHOT_TRACE_FRAMES)
+            self._snapshot = take_snapshot()
+            print('******** memory: started tracing allocations')
+            return []
+
+        snapshot = take_snapshot()
+        stats = snapshot.compare_to(self._snapshot, 'traceback')
+        self._snapshot = snapshot
+
+        print('******** memory: {}'.format(format_sample(sample())))
+        for stat in stats[:SNAPSHOT_TOP_COUNT]:
+            print('******** memory: {:+.1f} KiB in {} blocks ({:+}) at'.format(
+                    stat.size_diff / 1024, stat.count, stat.count_diff))
+            for line in stat.traceback.format():
+                print(line)
+        return stats[:SNAPSHOT_TOP_COUNT]
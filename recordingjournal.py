@@ -0,0 +1,68 @@
+# vim: set tw=99:
+
+# This file is part of FRC Replay, a system for automatically recording match
+# videos from live streams of FIRST games.
+
+# Copyright (C) 2017 Michael Smith <michael@spinda.net>
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+
+# You should have received a copy of the GNU Affero General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import threading
+
+# Tracks in-progress recordings so that they survive disconnects and restarts: for each one, the
+# match it belongs to and the archive time its clip starts at, plus the time it ends at once the
+# recording is finished but its clip hasn't been cut yet.
+class RecordingJournal:
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+
+        try:
+            with open(path, 'r', encoding='utf-8') as journal_file:
+                self._entries = json.load(journal_file)
+        except FileNotFoundError:
+            self._entries = {}
+
+    def entries(self):
+        with self._lock:
+            return [dict(entry) for entry in self._entries.values()]
+
+    def start(self, recording_id, match_id, start_time):
+        with self._lock:
+            self._entries[recording_id] = {
+                'id': recording_id,
+                'match_id': match_id,
+                'start_time': start_time
+            }
+            self._save()
+
+    def finish(self, recording_id, end_time):
+        with self._lock:
+            entry = self._entries.get(recording_id)
+            if entry is not None:
+                entry['end_time'] = end_time
+                self._save()
+
+    def remove(self, recording_id):
+        with self._lock:
+            if self._entries.pop(recording_id, None) is not None:
+                self._save()
+
+    def _save(self):
+        temp_path = self._path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as journal_file:
+            json.dump(self._entries, journal_file)
+        os.replace(temp_path, self._path)
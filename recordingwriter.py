@@ -0,0 +1,262 @@
+# vim: set tw=99:
+
+# This file is part of FRC Replay, a system for automatically recording match
+# videos from live streams of FIRST games.
+
+# Copyright (C) 2017 Michael Smith <michael@spinda.net>
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+
+# You should have received a copy of the GNU Affero General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import errno
+import os
+import queue
+import tempfile
+import threading
+import time
+import traceback
+
+RECORDING_BLOCK_SIZE = 1024 * 1024
+RECORDING_BLOCK_ALIGNMENT = 4096
+RECORDING_MAX_PENDING_BLOCKS = 64
+
+FSYNC_NEVER = 'never'
+FSYNC_ON_CLOSE = 'close'
+FSYNC_INTERVAL = 'interval'
+FSYNC_POLICIES = [FSYNC_NEVER, FSYNC_ON_CLOSE, FSYNC_INTERVAL]
+FSYNC_INTERVAL_SECONDS = 5
+
+LATENCY_SAMPLES = 4096
+LATENCY_PERCENTILES = [50, 95, 99]
+SLOW_WRITE_LATENCY = 0.5
+
+# Latencies of the blocks written since they were last taken, across all writers.
+_recent_latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+
+def percentile(sorted_values, p):
+    if len(sorted_values) == 0:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(p / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+def log_recent_latencies():
+    # Logs the write latency percentiles of the blocks written since the last call.
+    latencies = []
+    while len(_recent_latencies) > 0:
+        latencies.append(_recent_latencies.popleft())
+    latencies.sort()
+    if len(latencies) == 0:
+        print('******** recording writes: no blocks written')
+        return
+    print('******** recording writes: {} blocks, latency {}'.format(len(latencies), ', '.join(
+          'p{} {:.1f} ms'.format(p, percentile(latencies, p) * 1000)
+          for p in LATENCY_PERCENTILES)))
+
+# Incoming chunks are coalesced into aligned blocks and handed to a dedicated writer thread, so
+# write() doesn't block on disk I/O and a slow disk can't stall the stream reader. Only once the
+# disk has fallen RECORDING_MAX_PENDING_BLOCKS behind does write() wait for it, which holds the
+# stream back rather than letting memory grow without bound. The file is preallocated where the
+# platform supports it and truncated to the recorded length on close.
+#
+# If a write fails, the writer stops writing, the file is cut back to the blocks that made it to
+# disk in full, and error is set.
+class RecordingWriter:
+    def __init__(self, path, preallocate_size=0, fsync_policy=FSYNC_ON_CLOSE,
+                 block_size=RECORDING_BLOCK_SIZE):
+        if fsync_policy not in FSYNC_POLICIES:
+            raise Exception('Unrecognized fsync policy: ' + fsync_policy)
+        if block_size % RECORDING_BLOCK_ALIGNMENT != 0:
+            raise Exception('Block size {} is not a multiple of {}'.format(
+                            block_size, RECORDING_BLOCK_ALIGNMENT))
+
+        self.path = path
+        self.bytes_written = 0
+        self.error = None
+
+        self._preallocate_size = preallocate_size
+        self._fsync_policy = fsync_policy
+        self._block_size = block_size
+
+        self._buffer = bytearray()
+        self._blocks = queue.Queue(RECORDING_MAX_PENDING_BLOCKS)
+        self._latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+        self._closed = False
+        self._on_closed = None
+        self._stalled = False
+
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, data):
+        if self.error is not None:
+            return
+
+        self._buffer += data
+        if len(self._buffer) >= self._block_size:
+            block_end = len(self._buffer) - len(self._buffer) % self._block_size
+            block = bytes(self._buffer[:block_end])
+            del self._buffer[:block_end]
+
+            try:
+                self._blocks.put_nowait(block)
+                self._stalled = False
+            except queue.Full:
+                if not self._stalled:
+                    print('******** recording writer for {} is {} blocks behind; waiting for '
+                          'the disk'.format(self.path, RECORDING_MAX_PENDING_BLOCKS))
+                    self._stalled = True
+                self._blocks.put(block)
+
+    def close(self, on_closed=None):
+        # With on_closed, returns immediately and calls on_closed(self) from the writer thread
+        # once everything is on disk; otherwise waits for that to happen.
+        if self._closed:
+            return
+        self._closed = True
+        self._on_closed = on_closed
+
+        if len(self._buffer) > 0:
+            self._blocks.put(bytes(self._buffer))
+            self._buffer = bytearray()
+        self._blocks.put(None)
+
+        if on_closed is None:
+            self._thread.join()
+
+    def pending_blocks(self):
+        return self._blocks.qsize()
+
+    def latency_percentiles(self):
+        latencies = sorted(self._latencies)
+        return {'p{}'.format(p): percentile(latencies, p) for p in LATENCY_PERCENTILES}
+
+    def _run(self):
+        if self._preallocate_size > 0 and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(self._fd, 0, self._preallocate_size)
+            except OSError:
+                traceback.print_exc()
+
+        last_fsync_time = time.time()
+        while True:
+            block = self._blocks.get()
+            if block is None:
+                break
+            if self.error is not None:
+                continue
+
+            try:
+                # Writing at explicit offsets keeps a failed partial write from shifting where
+                # later blocks land; bytes_written only counts blocks that were written in full.
+                write_start_time = time.perf_counter()
+                view = memoryview(block)
+                written = 0
+                while written < len(view):
+                    written += os.pwrite(self._fd, view[written:], self.bytes_written + written)
+                self.bytes_written += len(block)
+
+                if self._fsync_policy == FSYNC_INTERVAL and \
+                   time.time() - last_fsync_time >= FSYNC_INTERVAL_SECONDS:
+                    os.fsync(self._fd)
+                    last_fsync_time = time.time()
+
+                latency = time.perf_counter() - write_start_time
+                self._latencies.append(latency)
+                _recent_latencies.append(latency)
+            except Exception as e:
+                traceback.print_exc()
+                self.error = e
+                print('******** recording writer for {} failed; keeping the first {} '
+                      'bytes'.format(self.path, self.bytes_written))
+
+        # Errors from here on are kept in error too, and on_closed is called regardless, since
+        # whoever is waiting for the recording to close would otherwise wait forever.
+        try:
+            try:
+                os.ftruncate(self._fd, self.bytes_written)
+                if self._fsync_policy != FSYNC_NEVER:
+                    os.fsync(self._fd)
+            finally:
+                os.close(self._fd)
+        except Exception as e:
+            traceback.print_exc()
+            if self.error is None:
+                self.error = e
+            print('******** recording writer for {} failed to close; {} bytes may not have made '
+                  'it to disk'.format(self.path, self.bytes_written))
+        finally:
+            # Stats are only logged when something was off, since the archive closes a writer
+            # every few seconds; log_recent_latencies() covers the rest.
+            latency_percentiles = self.latency_percentiles()
+            slowest_latency = latency_percentiles['p{}'.format(LATENCY_PERCENTILES[-1])]
+            if self.error is not None or \
+               (slowest_latency is not None and slowest_latency >= SLOW_WRITE_LATENCY):
+                print('******** recording writer stats for {}: {} bytes, latency {}'.format(
+                      self.path, self.bytes_written, latency_percentiles))
+
+            if self._on_closed is not None:
+                self._on_closed(self)
+
+def check_partial_write(temp_dir):
+    # The disk fills up partway through the third block.
+    path = os.path.join(temp_dir, 'partial-write')
+    real_pwrite = os.pwrite
+    def pwrite(fd, data, offset):
+        if offset >= 2 * RECORDING_BLOCK_SIZE:
+            if offset == 2 * RECORDING_BLOCK_SIZE:
+                return real_pwrite(fd, data[:RECORDING_BLOCK_SIZE // 2], offset)
+            raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+        return real_pwrite(fd, data, offset)
+
+    os.pwrite = pwrite
+    try:
+        writer = RecordingWriter(path)
+        for _ in range(4):
+            writer.write(b'\x01' * RECORDING_BLOCK_SIZE)
+        writer.close()
+    finally:
+        os.pwrite = real_pwrite
+
+    if writer.error is None or writer.bytes_written != 2 * RECORDING_BLOCK_SIZE or \
+       os.path.getsize(path) != 2 * RECORDING_BLOCK_SIZE:
+        raise Exception('A partial write left {} bytes in {} bytes on disk (error {!r})'.format(
+                        writer.bytes_written, os.path.getsize(path), writer.error))
+
+def check_failing_fsync(temp_dir):
+    path = os.path.join(temp_dir, 'failing-fsync')
+    real_fsync = os.fsync
+    def fsync(fd):
+        raise OSError(errno.EIO, os.strerror(errno.EIO))
+
+    closed = threading.Event()
+    os.fsync = fsync
+    try:
+        writer = RecordingWriter(path)
+        writer.write(b'\x01' * RECORDING_BLOCK_SIZE)
+        writer.close(lambda writer: closed.set())
+        closed_in_time = closed.wait(10)
+    finally:
+        os.fsync = real_fsync
+
+    if not closed_in_time:
+        raise Exception('A failing fsync kept on_closed from being called')
+    if writer.error is None:
+        raise Exception('A failing fsync was not reported in error')
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as temp_dir:
+        check_partial_write(temp_dir)
+        check_failing_fsync(temp_dir)
+    print('******** recording writer keeps what it wrote and signals close on disk errors')
@@ -0,0 +1,261 @@
+# vim: set tw=99:
+
+# This file is part of FRC Replay, a system for automatically recording match
+# videos from live streams of FIRST games.
+
+# Copyright (C) 2017 Michael Smith <michael@spinda.net>
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+
+# You should have received a copy of the GNU Affero General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import shutil
+import threading
+import traceback
+
+import recordingwriter
+
+ARCHIVE_INDEX_FILENAME = 'index.json'
+ARCHIVE_SEGMENT_FORMAT = '{:.3f}.seg'
+
+ARCHIVE_SEGMENT_DURATION = 10
+ARCHIVE_MAX_BYTES = 4 * 1024 * 1024 * 1024
+
+CLIP_COPY_CHUNK_SIZE = 16 * 1024 * 1024
+
+def copy_file_data(source_file, output_file):
+    # copy_file_range keeps the data in the kernel (and shares extents on filesystems that
+    # support reflinks); fall back to a plain copy where it isn't available.
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while os.copy_file_range(source_file.fileno(), output_file.fileno(),
+                                     CLIP_COPY_CHUNK_SIZE) > 0:
+                pass
+            return
+        except OSError:
+            pass
+    shutil.copyfileobj(source_file, output_file)
+
+# Continuously archives the stream into fixed-duration segment files, indexed by the time range
+# each one covers, so that clips can be cut out by time after the fact. The oldest segments are
+# evicted once the archive goes over its size budget, except those still needed by a pinned time
+# or a clip being extracted.
+class RollingArchive:
+    def __init__(self, archive_dir, segment_duration=ARCHIVE_SEGMENT_DURATION,
+                 max_bytes=ARCHIVE_MAX_BYTES, fsync_policy=recordingwriter.FSYNC_NEVER):
+        self._archive_dir = archive_dir
+        self._index_path = os.path.join(archive_dir, ARCHIVE_INDEX_FILENAME)
+        self._segment_duration = segment_duration
+        self._max_bytes = max_bytes
+        self._fsync_policy = fsync_policy
+
+        self._lock = threading.Lock()
+        self._pins = []
+        self._evicted_end_time = None
+        self._expected_segment_size = 0
+        self._closed_events = {}
+        self._current_writer = None
+        self._current_segment = None
+
+        os.makedirs(archive_dir, exist_ok=True)
+        self._segments = self._load_index()
+
+    def _load_index(self):
+        try:
+            with open(self._index_path, 'r', encoding='utf-8') as index_file:
+                segments = json.load(index_file)
+        except FileNotFoundError:
+            segments = []
+
+        # Segments that were still being written when the process died are taken as they are on
+        # disk.
+        loaded_segments = []
+        for segment in segments:
+            segment_path = os.path.join(self._archive_dir, segment['filename'])
+            try:
+                segment_stat = os.stat(segment_path)
+            except FileNotFoundError:
+                continue
+            if not segment['closed']:
+                segment['size'] = segment_stat.st_size
+                segment['end_time'] = max(segment['end_time'], segment_stat.st_mtime)
+                segment['closed'] = True
+            loaded_segments.append(segment)
+
+        indexed_filenames = {segment['filename'] for segment in loaded_segments}
+        indexed_filenames.add(ARCHIVE_INDEX_FILENAME)
+        for filename in os.listdir(self._archive_dir):
+            if filename not in indexed_filenames:
+                try:
+                    os.unlink(os.path.join(self._archive_dir, filename))
+                except:
+                    traceback.print_exc()
+
+        return loaded_segments
+
+    def write(self, data, timestamp):
+        if self._current_segment is None or \
+           timestamp - self._current_segment['start_time'] >= self._segment_duration:
+            self._start_segment(timestamp)
+
+        self._current_writer.write(data)
+        self._current_segment['end_time'] = timestamp
+
+    def end_time(self):
+        with self._lock:
+            if len(self._segments) == 0:
+                return None
+            return self._segments[-1]['end_time']
+
+    def flush(self):
+        # Finishes the current segment, as at a disconnect; the next write starts a new one.
+        self._finish_segment()
+        self._current_segment = None
+
+    def pin(self, start_time):
+        with self._lock:
+            self._pins.append(start_time)
+
+    def unpin(self, start_time):
+        with self._lock:
+            self._pins.remove(start_time)
+
+    def extract_clip(self, start_time, end_time, output_path, on_extracted, on_failed=None):
+        # Cuts the segments covering [start_time, end_time] into output_path on a background
+        # thread, then calls on_extracted(output_path), or on_failed(output_path, retryable) if
+        # that didn't work out. retryable is False when the archive no longer has (all of) the
+        # clip, so cutting it again won't help. Segments still being written are finished first.
+        if self._current_segment is not None and \
+           self._current_segment['start_time'] <= end_time:
+            self.flush()
+
+        self.pin(start_time)
+        threading.Thread(target=self._extract_clip,
+                         args=(start_time, end_time, output_path, on_extracted, on_failed),
+                         daemon=True).start()
+
+    def _extract_clip(self, start_time, end_time, output_path, on_extracted, on_failed):
+        missing = False
+        try:
+            with self._lock:
+                segments = [segment for segment in self._segments
+                            if segment['end_time'] >= start_time and
+                               segment['start_time'] <= end_time]
+                closed_events = [self._closed_events.get(segment['filename'])
+                                 for segment in segments]
+                # Eviction goes oldest first, so anything it took from the clip reaches its start.
+                evicted = self._evicted_end_time is not None and \
+                          self._evicted_end_time >= start_time
+
+            for closed_event in closed_events:
+                if closed_event is not None:
+                    closed_event.wait()
+
+            if evicted or sum(segment['size'] for segment in segments) == 0:
+                missing = True
+            else:
+                with open(output_path, 'wb') as output_file:
+                    for segment in segments:
+                        segment_path = os.path.join(self._archive_dir, segment['filename'])
+                        with open(segment_path, 'rb') as segment_file:
+                            copy_file_data(segment_file, output_file)
+
+                print('******** extracted {} archive segments into {}'.format(len(segments),
+                                                                               output_path))
+        except:
+            traceback.print_exc()
+            try:
+                os.unlink(output_path)
+            except FileNotFoundError:
+                pass
+            if on_failed is not None:
+                on_failed(output_path, True)
+            return
+        finally:
+            self.unpin(start_time)
+
+        if missing:
+            print('******** archive no longer has the segments for {}'.format(output_path))
+            if on_failed is not None:
+                on_failed(output_path, False)
+            return
+
+        on_extracted(output_path)
+
+    def _start_segment(self, timestamp):
+        self._finish_segment()
+
+        filename = ARCHIVE_SEGMENT_FORMAT.format(timestamp)
+        self._current_segment = {
+            'filename': filename,
+            'start_time': timestamp,
+            'end_time': timestamp,
+            'size': 0,
+            'closed': False
+        }
+        # Segments are preallocated at the size the previous one would have had over a full
+        # segment duration.
+        self._current_writer = recordingwriter.RecordingWriter(
+                os.path.join(self._archive_dir, filename), self._expected_segment_size,
+                self._fsync_policy)
+
+        # The index is saved once the previous segment is closed, off the stream thread.
+        with self._lock:
+            self._closed_events[filename] = threading.Event()
+            self._segments.append(self._current_segment)
+
+    def _finish_segment(self):
+        if self._current_writer is None:
+            return
+
+        segment = self._current_segment
+
+        def on_closed(writer):
+            with self._lock:
+                segment['size'] = writer.bytes_written
+                segment['closed'] = True
+                duration = segment['end_time'] - segment['start_time']
+                if duration > 0:
+                    self._expected_segment_size = int(writer.bytes_written *
+                                                      self._segment_duration / duration)
+                self._closed_events.pop(segment['filename']).set()
+                self._evict()
+                self._save_index()
+
+        self._current_writer.close(on_closed)
+        self._current_writer = None
+
+    def _evict(self):
+        total_bytes = sum(segment['size'] for segment in self._segments)
+        keep_after = min(self._pins) if len(self._pins) > 0 else None
+
+        while total_bytes > self._max_bytes and len(self._segments) > 0:
+            segment = self._segments[0]
+            if not segment['closed'] or \
+               (keep_after is not None and segment['end_time'] >= keep_after):
+                break
+
+            try:
+                os.unlink(os.path.join(self._archive_dir, segment['filename']))
+            except:
+                traceback.print_exc()
+            total_bytes -= segment['size']
+            self._evicted_end_time = segment['end_time']
+            del self._segments[0]
+
+    def _save_index(self):
+        temp_path = self._index_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as index_file:
+            json.dump(self._segments, index_file)
+        os.replace(temp_path, self._index_path)
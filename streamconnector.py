@@ -19,6 +19,8 @@
 # with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import io
+import re
+import threading
 import time
 import traceback
 
@@ -26,18 +28,63 @@ import requests
 import streamlink
 
 RECONNECT_OFFLINE_DELAY = 5
-RECONNECT_DC_DELAY = 1
+RECONNECT_MIN_DELAY = 0.1
+RECONNECT_MAX_DELAY = 5
+RECONNECT_MIN_UPTIME = 5
+
+STANDBY_REFRESH_INTERVAL = 60
+
+HTTP_TIMEOUT = 10
 
 TWITCH_URL_TEMPLATE = 'https://www.twitch.tv/{}'
 TWITCH_ONLINE_ENDPOINT = 'https://api.twitch.tv/kraken/streams/{}?client_id=5j0r5b7qb7kro03fvka3o8kbq262wwm&callback=badge.drawStream'
 
 STREAM_QUALITY = 'best'
 
+STREAM_NAME_RE = re.compile(r'^([0-9]+)p')
+DEFAULT_STREAM_RESOLUTION = (1920, 1080)
+
+def stream_resolution(streams, quality):
+    # Twitch names its renditions after their height ('720p60', '480p', ...) and 'best'/'worst'
+    # alias one of those, so look for a named rendition that is the same stream.
+    for name, stream in streams.items():
+        match = STREAM_NAME_RE.match(name)
+        if match and stream is streams[quality]:
+            height = int(match.group(1))
+            return (int(round(height * 16 / 9 / 2)) * 2, height)
+    return DEFAULT_STREAM_RESOLUTION
+
+def next_reconnect_delay(reconnect_delay):
+    return min(max(reconnect_delay * 2, RECONNECT_MIN_DELAY), RECONNECT_MAX_DELAY)
+
 class StreamConnector:
-    def __init__(self, event_id, twitch_id):
+    def __init__(self, event_id, twitch_id, detector_quality=None, stream_url=None,
+                 warm_standby=False):
         self.event_id = event_id
         self.twitch_id = twitch_id
 
+        # A stream URL overrides the Twitch channel, e.g. 'hls://http://localhost:8000/live.m3u8'
+        # for a local HLS server; the Twitch online check is skipped for it.
+        self.stream_url = stream_url
+
+        # Resolved streams are reused for reconnects until opening them fails. With a warm
+        # standby, they are also re-resolved in the background while connected, so a dropped
+        # stream can be reopened right away with fresh playlist URLs.
+        self.warm_standby = warm_standby
+        self._streams = None
+        self._streams_lock = threading.Lock()
+        self._http_session = requests.Session()
+        self._streamlink_session = streamlink.Streamlink()
+
+        # With a detector quality set, a second, smaller rendition of the broadcast is opened
+        # alongside the recorded one and passed to on_detector_data instead.
+        self.detector_quality = detector_quality
+        self.detector_stream_open = False
+        self.detector_resolution = DEFAULT_STREAM_RESOLUTION
+
+    def on_start(self):
+        pass
+
     def on_connecting(self):
         pass
 
@@ -50,44 +97,140 @@ class StreamConnector:
     def on_data(self, data):
         pass
 
-    def run(self):
-        twitch_url = TWITCH_URL_TEMPLATE.format(self.twitch_id)
-        print('******** starting loop for event {}, stream {}'.format(self.event_id, twitch_url))
+    def on_detector_data(self, data):
+        pass
 
+    def _read_detector_stream(self, detector_stream):
+        try:
+            while True:
+                data = detector_stream.read(io.DEFAULT_BUFFER_SIZE)
+                if len(data) == 0:
+                    break
+                self.on_detector_data(data)
+        except:
+            traceback.print_exc()
+
+    def _fetch_streams(self, url, http_session, streamlink_session):
+        if self.stream_url is None:
+            r = http_session.get(TWITCH_ONLINE_ENDPOINT.format(self.twitch_id),
+                                 timeout=HTTP_TIMEOUT)
+            r.raise_for_status()
+            if '"stream":null,' in r.text:
+                return None
+
+        streams = streamlink_session.streams(url)
+        if STREAM_QUALITY not in streams:
+            return None
+        return streams
+
+    def _resolve_streams(self, url):
+        with self._streams_lock:
+            if self._streams is not None:
+                return self._streams
+
+        streams = self._fetch_streams(url, self._http_session, self._streamlink_session)
+        with self._streams_lock:
+            self._streams = streams
+        return streams
+
+    def _invalidate_streams(self):
+        with self._streams_lock:
+            self._streams = None
+
+    def _refresh_standby(self, url):
+        http_session = requests.Session()
+        streamlink_session = streamlink.Streamlink()
         while True:
+            time.sleep(STANDBY_REFRESH_INTERVAL)
             try:
-                self.on_connecting()
+                streams = self._fetch_streams(url, http_session, streamlink_session)
+                if streams is not None:
+                    with self._streams_lock:
+                        self._streams = streams
+            except:
+                traceback.print_exc()
 
-                r = requests.get(TWITCH_ONLINE_ENDPOINT.format(self.twitch_id))
-                r.raise_for_status()
-                if '"stream":null,' in r.text:
-                    time.sleep(RECONNECT_OFFLINE_DELAY)
-                    continue
-
-                streams = streamlink.streams(twitch_url)
-                if STREAM_QUALITY not in streams:
-                    time.sleep(RECONNECT_DC_DELAY)
-                    continue
-                stream = streams[STREAM_QUALITY]
-
-                with stream.open() as s:
-                    self.on_connected()
-                    print('******** connected to stream {} for event {}'.format(twitch_url,
-                                                                                self.event_id))
+    def _read_stream(self, url, streams):
+        # Returns whether any data was read.
+        stream = streams[STREAM_QUALITY]
 
-                    try:
-                        while True:
-                            data = s.read(io.DEFAULT_BUFFER_SIZE)
-                            if len(data) == 0:
-                                break
-                            self.on_data(data)
-                    finally:
-                        self.on_disconnected()
-                        print('******** disconnected from stream {} for event {}'.format(twitch_url,
+        detector_quality = STREAM_QUALITY
+        if self.detector_quality in streams and streams[self.detector_quality] is not stream:
+            detector_quality = self.detector_quality
+        self.detector_resolution = stream_resolution(streams, detector_quality)
+
+        received_data = False
+        with stream.open() as s:
+            # Both renditions are opened back to back at the live edge, which keeps them within
+            # about a segment of each other; the prematch time covers the rest.
+            detector_stream = None
+            detector_thread = None
+            if detector_quality != STREAM_QUALITY:
+                detector_stream = streams[detector_quality].open()
+            self.detector_stream_open = detector_stream is not None
+
+            self.on_connected()
+            print('******** connected to stream {} for event {}'.format(url, self.event_id))
+
+            try:
+                if detector_stream is not None:
+                    detector_thread = threading.Thread(target=self._read_detector_stream,
+                                                       args=(detector_stream,), daemon=True)
+                    detector_thread.start()
+                    print('******** detecting matches from {} stream'.format(detector_quality))
+
+                while True:
+                    if detector_thread is not None and not detector_thread.is_alive():
+                        print('******** lost {} stream'.format(detector_quality))
+                        break
+                    data = s.read(io.DEFAULT_BUFFER_SIZE)
+                    if len(data) == 0:
+                        break
+                    received_data = True
+                    self.on_data(data)
+            finally:
+                if detector_stream is not None:
+                    detector_stream.close()
+                if detector_thread is not None:
+                    detector_thread.join()
+                self.detector_stream_open = False
+                self.on_disconnected()
+                print('******** disconnected from stream {} for event {}'.format(url,
                                                                                 self.event_id))
+        return received_data
+
+    def run(self):
+        url = self.stream_url or TWITCH_URL_TEMPLATE.format(self.twitch_id)
+        print('******** starting loop for event {}, stream {}'.format(self.event_id, url))
+
+        self.on_start()
+        if self.warm_standby:
+            threading.Thread(target=self._refresh_standby, args=(url,), daemon=True).start()
+
+        reconnect_delay = 0
+        while True:
+            try:
+                self.on_connecting()
+
+                streams = self._resolve_streams(url)
+                if streams is None:
+                    reconnect_delay = RECONNECT_OFFLINE_DELAY
+                else:
+                    connect_time = time.time()
+                    if not self._read_stream(url, streams):
+                        self._invalidate_streams()
+
+                    # A stream that was up for a while and just dropped is reconnected right
+                    # away; one that keeps dropping straight after connecting backs off.
+                    if time.time() - connect_time >= RECONNECT_MIN_UPTIME:
+                        reconnect_delay = 0
+                    else:
+                        reconnect_delay = next_reconnect_delay(reconnect_delay)
             except KeyboardInterrupt:
                 raise
             except:
                 traceback.print_exc()
+                self._invalidate_streams()
+                reconnect_delay = next_reconnect_delay(reconnect_delay)
 
-            time.sleep(RECONNECT_DC_DELAY)
+            time.sleep(reconnect_delay)
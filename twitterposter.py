@@ -0,0 +1,326 @@
+# vim: set tw=99:
+
+# This file is part of FRC Replay, a system for automatically recording match
+# videos from live streams of FIRST games.
+
+# Copyright (C) 2017 Michael Smith <michael@spinda.net>
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+
+# You should have received a copy of the GNU Affero General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import http.server
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import traceback
+import urllib.parse
+
+import videohandler
+
+TWEET_THREADS_PATH = os.path.join(videohandler.VIDEOS_DIR, 'tweet-threads.json')
+TWEET_THREADS_MAX_TITLES = 256
+
+# Twitter allows 300 status updates per user in any 3 hour window.
+TWEET_RATE_LIMIT = 300
+TWEET_RATE_WINDOW = 3 * 60 * 60
+
+TWEET_POLL_INTERVAL = 1
+TWEET_RETRY_MIN_DELAY = 5
+TWEET_RETRY_MAX_DELAY = 15 * 60
+TWEET_MAX_ATTEMPTS = 5
+
+FAILED_TWEETS_DIRNAME = 'failed'
+
+TWITTER_API_BASE_URL = os.environ.get('TWITTER_API_BASE_URL')
+
+# Titles look like '[2017-03-04] #2017wasno #Quarterfinal Tiebreaker 1': the date, the event id,
+# then the round, kind and number of match as read off the overlay.
+TITLE_RE = re.compile(r'^(\[[^\]]*\]) #\S+ #(\w+) (Match|Tiebreaker) (?:(\d+)$)?')
+
+# Playoff rounds play one match of each of their series in turn, and then their tiebreakers in the
+# same order, so match or tiebreaker n of a round belongs to series (n - 1) % series + 1.
+ROUND_SERIES = {'Quarterfinal': 4, 'Semifinal': 2, 'Final': 1}
+
+def thread_keys(title):
+    # A title is threaded under an earlier tweet with the same title (a match video that was
+    # split into several parts), and a tiebreaker under the latest match of its series. Rounds
+    # that aren't split into known series are threaded by round instead.
+    match = TITLE_RE.match(title)
+    if match is None:
+        return (None, None)
+    is_tiebreaker = match.group(3) == 'Tiebreaker'
+    series_count = ROUND_SERIES.get(match.group(2))
+    if series_count is None or match.group(4) is None:
+        return ('{} {}'.format(match.group(1), match.group(2)), is_tiebreaker)
+
+    series = (int(match.group(4)) - 1) % series_count + 1
+    return ('{} {} {}'.format(match.group(1), match.group(2), series), is_tiebreaker)
+
+class TwitterPoster:
+    def __init__(self, tweets_dir=videohandler.TWEETS_DIR, threads_path=TWEET_THREADS_PATH):
+        self._tweets_dir = tweets_dir
+        self._threads_path = threads_path
+
+        self._clients = {}
+        self._post_times = collections.defaultdict(collections.deque)
+        self._attempts = {}
+        self._retry_delay = TWEET_RETRY_MIN_DELAY
+
+        try:
+            with open(threads_path, 'r', encoding='utf-8') as threads_file:
+                self._threads = json.load(threads_file,
+                                          object_pairs_hook=collections.OrderedDict)
+        except FileNotFoundError:
+            self._threads = {}
+
+        os.makedirs(tweets_dir, exist_ok=True)
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while True:
+            try:
+                if not self.post_pending():
+                    time.sleep(TWEET_POLL_INTERVAL)
+                    continue
+                self._retry_delay = TWEET_RETRY_MIN_DELAY
+            except KeyboardInterrupt:
+                raise
+            except:
+                traceback.print_exc()
+                print('******** retrying tweets in {}s'.format(self._retry_delay))
+                time.sleep(self._retry_delay)
+                self._retry_delay = min(self._retry_delay * 2, TWEET_RETRY_MAX_DELAY)
+
+    def post_pending(self):
+        # A tweet the API rejects doesn't hold up the ones after it, and is moved aside into the
+        # failed directory once it has been tried TWEET_MAX_ATTEMPTS times. Other errors, like the
+        # API being unreachable, are raised right away.
+        tweet_filenames = sorted(filename for filename in os.listdir(self._tweets_dir)
+                                 if filename.endswith('.json'))
+        posted = False
+        rejected = False
+        for tweet_filename in tweet_filenames:
+            tweet_path = os.path.join(self._tweets_dir, tweet_filename)
+            with open(tweet_path, 'r', encoding='utf-8') as tweet_file:
+                tweet = json.load(tweet_file)
+
+            if not self._rate_limit_allows(tweet['twitter_user']):
+                continue
+
+            try:
+                self._post(tweet['title'], tweet['link'], tweet['twitter_user'])
+            except Exception as e:
+                import twitter
+                if not isinstance(e, twitter.TwitterError):
+                    raise
+                traceback.print_exc()
+                self._reject(tweet_filename)
+                rejected = True
+                continue
+
+            self._attempts.pop(tweet_filename, None)
+            os.unlink(tweet_path)
+            posted = True
+
+        # Back off before trying rejected tweets again.
+        if rejected:
+            raise Exception('Twitter rejected some tweets')
+        return posted
+
+    def _reject(self, tweet_filename):
+        attempts = self._attempts.get(tweet_filename, 0) + 1
+        if attempts < TWEET_MAX_ATTEMPTS:
+            self._attempts[tweet_filename] = attempts
+            return
+
+        del self._attempts[tweet_filename]
+        failed_dir = os.path.join(self._tweets_dir, FAILED_TWEETS_DIRNAME)
+        os.makedirs(failed_dir, exist_ok=True)
+        os.rename(os.path.join(self._tweets_dir, tweet_filename),
+                  os.path.join(failed_dir, tweet_filename))
+        print('******** gave up on tweet {} after {} attempts'.format(tweet_filename, attempts))
+
+    def _rate_limit_allows(self, twitter_user):
+        post_times = self._post_times[twitter_user]
+        while len(post_times) > 0 and time.time() - post_times[0] >= TWEET_RATE_WINDOW:
+            post_times.popleft()
+        return len(post_times) < TWEET_RATE_LIMIT
+
+    def _client(self, twitter_user):
+        client = self._clients.get(twitter_user)
+        if client is None:
+            import twitter
+            client = twitter.Api(base_url=TWITTER_API_BASE_URL,
+                                 **videohandler.load_credentials()['twitter'][twitter_user])
+            self._clients[twitter_user] = client
+        return client
+
+    def _post(self, title, link, twitter_user):
+        # 'rounds' holds the latest tweet of each series (or round), by thread key.
+        threads = self._threads.setdefault(twitter_user, {'titles': collections.OrderedDict(),
+                                                          'rounds': {}})
+        series_key, is_tiebreaker = thread_keys(title)
+
+        reply_to = threads['titles'].get(title)
+        if reply_to is None and is_tiebreaker:
+            reply_to = threads['rounds'].get(series_key)
+
+        tweet = videohandler.TWEET_FORMAT.format(title, link)
+        status = self._client(twitter_user).PostUpdate(tweet, in_reply_to_status_id=reply_to)
+        self._post_times[twitter_user].append(time.time())
+        print('******** posted tweet: {}'.format(status.text))
+
+        # Replies extend the thread, so later parts chain off the newest tweet.
+        threads['titles'].pop(title, None)
+        threads['titles'][title] = status.id
+        while len(threads['titles']) > TWEET_THREADS_MAX_TITLES:
+            del threads['titles'][next(iter(threads['titles']))]
+        if series_key is not None:
+            threads['rounds'][series_key] = status.id
+        self._save_threads()
+
+    def _save_threads(self):
+        temp_path = self._threads_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as threads_file:
+            json.dump(self._threads, threads_file)
+        os.replace(temp_path, self._threads_path)
+
+# A stand-in for the Twitter API's statuses/update endpoint, which is all the poster uses. Like the
+# real one, it rejects a status that duplicates an earlier one.
+class FakeTwitterAPIHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8')
+        fields = urllib.parse.parse_qs(body)
+        if any(status['status'] == fields['status'][0] for status in self.server.statuses):
+            self._respond(403, {'errors': [{'code': 187, 'message': 'Status is a duplicate.'}]})
+            return
+
+        status_id = len(self.server.statuses) + 1
+        self.server.statuses.append({'id': status_id, 'status': fields['status'][0],
+                                     'in_reply_to_status_id':
+                                         fields.get('in_reply_to_status_id', [None])[0]})
+        self._respond(200, {'id': status_id, 'text': fields['status'][0]})
+
+    def _respond(self, code, body):
+        response = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
+
+def check_thread_keys():
+    import matchobserver
+    import matchrecorder
+
+    def title(match_id):
+        return matchrecorder.TITLE_FORMAT.format(
+                '2017-03-04', matchobserver.MATCH_ID_TEMPLATE.format('2017wasno', match_id))
+
+    # In posting order; the quarterfinal tiebreaker belongs with matches 1 and 5, not with the
+    # matches posted in between.
+    expected_keys = [
+        (title('#Qualification Match 12'), ('[2017-03-04] Qualification', False)),
+        (title('#Quarterfinal Match 1'), ('[2017-03-04] Quarterfinal 1', False)),
+        (title('#Quarterfinal Match 2'), ('[2017-03-04] Quarterfinal 2', False)),
+        (title('#Quarterfinal Match 5'), ('[2017-03-04] Quarterfinal 1', False)),
+        (title('#Quarterfinal Match 6'), ('[2017-03-04] Quarterfinal 2', False)),
+        (title('#Quarterfinal Tiebreaker 1'), ('[2017-03-04] Quarterfinal 1', True)),
+        (title('#Semifinal Match 1'), ('[2017-03-04] Semifinal 1', False)),
+        ('Hello World', (None, None))
+    ]
+    for title, keys in expected_keys:
+        if thread_keys(title) != keys:
+            raise Exception('thread_keys({!r}) is {}, not {}'.format(title, thread_keys(title),
+                                                                     keys))
+    return [title for title, _ in expected_keys[:-1]]
+
+def start_fake_api(twitter_user):
+    global TWITTER_API_BASE_URL
+
+    server = http.server.HTTPServer(('127.0.0.1', 0), FakeTwitterAPIHandler)
+    server.statuses = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    TWITTER_API_BASE_URL = 'http://127.0.0.1:{}'.format(server.server_port)
+
+    videohandler._credentials = {'twitter': {twitter_user: {
+        'consumer_key': 'fake', 'consumer_secret': 'fake',
+        'access_token_key': 'fake', 'access_token_secret': 'fake'
+    }}}
+    return server
+
+def spool_tweet(tweets_dir, index, title, link, twitter_user):
+    with open(os.path.join(tweets_dir, '{:04}.json'.format(index)), 'w',
+              encoding='utf-8') as tweet_file:
+        json.dump({'title': title, 'link': link, 'twitter_user': twitter_user}, tweet_file)
+
+def check_fake_api(titles):
+    twitter_user = 'frc_replay'
+    server = start_fake_api(twitter_user)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        tweets_dir = os.path.join(temp_dir, 'tweets')
+        poster = TwitterPoster(tweets_dir, os.path.join(temp_dir, 'tweet-threads.json'))
+        for index, title in enumerate(titles):
+            spool_tweet(tweets_dir, index, title, 'https://streamable.com/{}'.format(index),
+                        twitter_user)
+            poster.post_pending()
+    server.shutdown()
+
+    # Only the tiebreaker replies, to quarterfinal match 5 rather than match 6 after it.
+    reply_ids = [status['in_reply_to_status_id'] for status in server.statuses]
+    if reply_ids != [None, None, None, None, None, '4', None]:
+        raise Exception('Tweets replied to {}'.format(reply_ids))
+
+def check_rejected_tweets(titles):
+    twitter_user = 'frc_replay'
+    server = start_fake_api(twitter_user)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        tweets_dir = os.path.join(temp_dir, 'tweets')
+        poster = TwitterPoster(tweets_dir, os.path.join(temp_dir, 'tweet-threads.json'))
+
+        # The second tweet duplicates the first, so the API rejects it every time.
+        spool_tweet(tweets_dir, 0, titles[0], 'https://streamable.com/0', twitter_user)
+        spool_tweet(tweets_dir, 1, titles[0], 'https://streamable.com/0', twitter_user)
+        spool_tweet(tweets_dir, 2, titles[1], 'https://streamable.com/2', twitter_user)
+        for attempt in range(TWEET_MAX_ATTEMPTS):
+            try:
+                poster.post_pending()
+            except Exception:
+                pass
+            if attempt == 0 and len(server.statuses) != 2:
+                raise Exception('A rejected tweet held up the ones after it')
+
+        remaining_filenames = sorted(os.listdir(tweets_dir))
+        failed_filenames = os.listdir(os.path.join(tweets_dir, FAILED_TWEETS_DIRNAME))
+    server.shutdown()
+
+    if remaining_filenames != [FAILED_TWEETS_DIRNAME] or failed_filenames != ['0001.json']:
+        raise Exception('Left {} pending and {} failed after {} attempts'.format(
+                        remaining_filenames, failed_filenames, TWEET_MAX_ATTEMPTS))
+
+if __name__ == '__main__':
+    titles = check_thread_keys()
+    check_fake_api(titles)
+    check_rejected_tweets(titles)
+    print('******** tweet threading and rejections work against a fake Twitter API')
@@ -20,36 +20,52 @@
 
 import json
 import os
+import time
 import traceback
 
-import requests
-import requests_toolbelt.multipart.encoder
 import retrying
-import twitter
 
-VIDEOS_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'videos')
+VIDEOS_DIR = os.environ.get('FRCREPLAY_VIDEOS_DIR',
+                            os.path.join(os.path.dirname(os.path.realpath(__file__)), 'videos'))
+TWEETS_DIR = os.path.join(VIDEOS_DIR, 'tweets')
+TWEET_SPOOL_FORMAT = os.path.join(TWEETS_DIR, '{:.6f}-{}.json')
 
 RETRY_DELAY = 60000
 
 STREAMABLE_UPLOAD_ENDPOINT = 'https://api.streamable.com/upload'
 STREAMABLE_LINK_FORMAT = 'https://streamable.com/{}'
 
-with open('credentials.json', 'r', encoding='utf-8') as credentials_file:
-    CREDENTIALS = json.load(credentials_file)
+CREDENTIALS_PATH = 'credentials.json'
+_credentials = None
 
 TWEET_FORMAT = '{} {}'
 STREAMABLE_TITLE_FORMAT = '{} (twitter.com/{})'
 
+def load_credentials():
+    global _credentials
+    if _credentials is None:
+        with open(CREDENTIALS_PATH, 'r', encoding='utf-8') as credentials_file:
+            _credentials = json.load(credentials_file)
+    return _credentials
+
+# The HTTP client libraries are imported inside the functions below, which only run in upload
+# processes, so importing this module doesn't slow down recorder startup.
+
 @retrying.retry(wait_fixed=RETRY_DELAY)
 def upload_to_streamable(title, path):
+    import requests
+    import requests_toolbelt.multipart.encoder
+
     try:
         print('******** uploading video for {} to streamable'.format(title))
         traceback.print_stack()
 
-        encoder = requests_toolbelt.multipart.encoder.MultipartEncoder(
-                fields={'title':title, 'files[]': ('video.mp4', open(path, 'rb'), 'video/mp4')})
-        r = requests.post(STREAMABLE_UPLOAD_ENDPOINT,
-                          data=encoder, headers={'Content-Type': encoder.content_type})
+        # Every retry opens the video again, so make sure each attempt closes it.
+        with open(path, 'rb') as video_file:
+            encoder = requests_toolbelt.multipart.encoder.MultipartEncoder(
+                    fields={'title':title, 'files[]': ('video.mp4', video_file, 'video/mp4')})
+            r = requests.post(STREAMABLE_UPLOAD_ENDPOINT,
+                              data=encoder, headers={'Content-Type': encoder.content_type})
         print('******** streamable response for {}: {}'.format(title, r.text))
         r.raise_for_status()
 
@@ -61,19 +77,19 @@ def upload_to_streamable(title, path):
         traceback.print_exc()
         raise
 
-@retrying.retry(wait_fixed=RETRY_DELAY)
-def post_video_to_twitter(title, link, twitter_user):
-    try:
-        tweet = TWEET_FORMAT.format(title, link)
-        status = twitter.Api(**CREDENTIALS['twitter'][twitter_user]).PostUpdate(tweet)
-        print('******** posted tweet: {}'.format(status.text))
-    except:
-        traceback.print_exc()
-        raise
-
-def upload_to_streamable_and_post_to_twitter(title, path, twitter_user):
+def queue_tweet(title, link, twitter_user):
+    # Tweets are handed to the recorder's TwitterPoster through a spool directory, which also
+    # keeps them around across restarts until they are posted.
+    os.makedirs(TWEETS_DIR, exist_ok=True)
+    tweet_path = TWEET_SPOOL_FORMAT.format(time.time(), os.getpid())
+    with open(tweet_path + '.tmp', 'w', encoding='utf-8') as tweet_file:
+        json.dump({'title': title, 'link': link, 'twitter_user': twitter_user}, tweet_file)
+    os.replace(tweet_path + '.tmp', tweet_path)
+    print('******** queued tweet for {}'.format(title))
+
+def upload_to_streamable_and_queue_tweet(title, path, twitter_user):
     link = upload_to_streamable(STREAMABLE_TITLE_FORMAT.format(title, twitter_user), path)
-    post_video_to_twitter(title, link, twitter_user)
+    queue_tweet(title, link, twitter_user)
     try:
         os.unlink(path)
     except:
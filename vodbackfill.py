@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+# vim: set tw=99:
+
+# This file is part of FRC Replay, a system for automatically recording match
+# videos from live streams of FIRST games.
+
+# Copyright (C) 2017 Michael Smith <michael@spinda.net>
+
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+
+# You should have received a copy of the GNU Affero General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Recovers match videos from a full-day VOD file when live recording failed. The VOD is split
+# into time ranges that are scanned for matches in parallel, the per-frame results are stitched
+# back into a single timeline, and every match clip is then cut out in one pass over the file
+# and dropped into the recorder's ready directory for uploading.
+
+import argparse
+import datetime
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+import matchobserver
+import matchrecorder
+
+FFPROBE_BINARY = '/usr/bin/ffprobe'
+FFPROBE_DURATION_COMMAND = [
+    FFPROBE_BINARY, '-v', 'error', '-show_entries', 'format=duration',
+    '-of', 'default=noprint_wrappers=1:nokey=1'
+]
+
+SHARDS_PER_JOB = 4
+FRAME_INTERVAL = 1 / matchobserver.MATCH_DETECTOR_FPS
+
+def vod_duration(vod_path):
+    return float(subprocess.check_output(FFPROBE_DURATION_COMMAND + [vod_path]))
+
+def scan_shard(shard):
+    game_id, vod_path, start_time, duration, video_width, video_height = shard
+
+    vision_core_class = matchobserver.load_game_plugin(game_id).VISION_CORE_CLASS
+    vision_core = vision_core_class(video_width, video_height)
+
+    ffmpeg_command = [
+        matchobserver.FFMPEG_BINARY, '-v', 'error',
+        '-ss', str(start_time), '-t', str(duration), '-i', vod_path,
+        '-vf', matchobserver.FFMPEG_FRAME_FILTER.format(video_width, video_height)
+    ] + matchobserver.FFMPEG_FRAME_OUTPUT
+    frame_extractor = subprocess.Popen(ffmpeg_command, stdout=subprocess.PIPE)
+
+    timeline = []
+    try:
+        frames = matchobserver.iter_frames(frame_extractor.stdout, video_width, video_height)
+        for frame_index, frame in enumerate(frames):
+            try:
+                match_id, _ = vision_core.process_frame(frame)
+            except:
+                traceback.print_exc()
+                match_id = None
+            timeline.append((start_time + frame_index * FRAME_INTERVAL, match_id))
+    finally:
+        frame_extractor.stdout.close()
+        frame_extractor.wait()
+
+    print('******** scanned {:.0f}s-{:.0f}s: {} frames'.format(start_time, start_time + duration,
+                                                              len(timeline)))
+    return timeline
+
+def find_matches(event_id, timeline, end_time):
+    # Runs the same smoothing as live detection over the stitched timeline, so matches that
+    # straddle a shard boundary come out whole.
+    match_tracker = matchobserver.MatchTracker(event_id)
+    matches = []
+
+    match_id = None
+    match_start_time = None
+    for timestamp, frame_match_id in timeline:
+        if match_tracker.update(frame_match_id, timestamp) and match_tracker.match_id != match_id:
+            if match_id is not None:
+                matches.append((match_id, match_start_time, timestamp))
+            match_id = match_tracker.match_id
+            match_start_time = timestamp
+    if match_id is not None:
+        matches.append((match_id, match_start_time, end_time))
+
+    clips = []
+    for match_id, start_time, end_time in matches:
+        clip_start_time = max(0, start_time - matchrecorder.PREMATCH_TIME)
+        while clip_start_time < end_time:
+            clip_end_time = min(end_time, clip_start_time + matchrecorder.SPLIT_AT_TIME)
+            clips.append((match_id, clip_start_time, clip_end_time))
+            clip_start_time = clip_end_time
+    return clips
+
+def cut_clips(vod_path, clips, date):
+    # Every clip is a separate output of one FFmpeg run, so the VOD is only read once.
+    clips_dir = tempfile.mkdtemp(dir=matchrecorder.VIDEOS_DIR)
+    try:
+        ffmpeg_command = [matchobserver.FFMPEG_BINARY, '-v', 'error', '-i', vod_path]
+        clip_paths = []
+        for clip_index, (_, start_time, end_time) in enumerate(clips):
+            clip_path = os.path.join(clips_dir, '{}.mp4'.format(clip_index))
+            ffmpeg_command += ['-ss', str(start_time), '-to', str(end_time),
+                               '-map', '0:v', '-map', '0:a?', '-c', 'copy', '-f', 'mp4', clip_path]
+            clip_paths.append(clip_path)
+        subprocess.check_call(ffmpeg_command)
+
+        for clip_index, ((match_id, _, _), clip_path) in enumerate(zip(clips, clip_paths)):
+            title = matchrecorder.TITLE_FORMAT.format(date, match_id)
+            ready_path = matchrecorder.READY_FORMAT.format(
+                    '{}-{:04}'.format(int(time.time()), clip_index), title)
+            os.rename(clip_path, ready_path)
+            print('******** ready: {}'.format(ready_path))
+    finally:
+        shutil.rmtree(clips_dir, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description='Recover match videos from a full-day VOD.')
+    parser.add_argument('event_id')
+    parser.add_argument('game_id')
+    parser.add_argument('vod_path')
+    parser.add_argument('--date', default=datetime.date.today().isoformat(),
+                        help='date to put in video titles (default: today)')
+    parser.add_argument('--jobs', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--width', type=int, default=matchobserver.DEFAULT_VIDEO_WIDTH)
+    parser.add_argument('--height', type=int, default=matchobserver.DEFAULT_VIDEO_HEIGHT)
+    args = parser.parse_args()
+
+    matchobserver.check_game_plugin(args.game_id)
+
+    duration = vod_duration(args.vod_path)
+    shard_count = max(1, args.jobs * SHARDS_PER_JOB)
+    # Shards start on frame boundaries so the stitched timeline keeps an even frame interval.
+    shard_duration = max(FRAME_INTERVAL,
+                         round(duration / shard_count / FRAME_INTERVAL) * FRAME_INTERVAL)
+    shards = []
+    shard_start_time = 0
+    while shard_start_time < duration:
+        shards.append((args.game_id, args.vod_path, shard_start_time, shard_duration,
+                       args.width, args.height))
+        shard_start_time += shard_duration
+
+    print('******** scanning {:.0f}s of video in {} shards on {} processes'.format(
+          duration, len(shards), args.jobs))
+    with multiprocessing.Pool(args.jobs) as pool:
+        timeline = [entry for shard_timeline in pool.map(scan_shard, shards, chunksize=1)
+                    for entry in shard_timeline]
+
+    clips = find_matches(args.event_id, timeline, duration)
+    print('******** found {} clips'.format(len(clips)))
+    if len(clips) > 0:
+        cut_clips(args.vod_path, clips, args.date)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())